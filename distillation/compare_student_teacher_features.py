@@ -1,11 +1,44 @@
 import os
+import csv
 import torch
+import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
 import random
+from PIL import Image, ImageDraw
 import torch.nn.functional as F
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def mean_std_difference(student_embeddings, teacher_embeddings):
+def batch_statistics(student_embeddings, teacher_embeddings):
+    """
+    Computes the per-sample statistics of a batch of student and teacher embeddings in a single pass
+    over (B, -1) views, with a single device -> host transfer.
+
+    Args:
+        student_embeddings (torch.Tensor): A batch of student embeddings of shape (B, ...).
+        teacher_embeddings (torch.Tensor): A batch of teacher embeddings of shape (B, ...).
+
+    Returns:
+        dict: Lists of B floats for "student_mean", "student_std", "teacher_mean", "teacher_std",
+              "diff_mean", "diff_std" and "cosine_sim".
+    """
+    B = student_embeddings.shape[0]
+    s_flat = student_embeddings.reshape(B, -1)
+    t_flat = teacher_embeddings.reshape(B, -1)
+    diff = s_flat - t_flat
+    stats = torch.stack([
+        s_flat.mean(dim=1).double(),
+        s_flat.std(dim=1).double(),
+        t_flat.mean(dim=1).double(),
+        t_flat.std(dim=1).double(),
+        diff.mean(dim=1).double(),
+        diff.std(dim=1).double(),
+        F.cosine_similarity(s_flat.float(), t_flat.float(), dim=1).double(),
+    ]).cpu().tolist()  # single device -> host sync
+    names = ["student_mean", "student_std", "teacher_mean", "teacher_std", "diff_mean", "diff_std", "cosine_sim"]
+    return dict(zip(names, stats))
+
+def mean_std_difference(student_embeddings, teacher_embeddings, verbose=True, chunk_size=None):
     """
     Computes and prints the mean and standard deviation of student and teacher embeddings for each batch,
     as well as the mean and standard deviation of their differences. Also calculates and prints the average
@@ -15,9 +48,12 @@ def mean_std_difference(student_embeddings, teacher_embeddings):
     Args:
         student_embeddings (torch.Tensor): A batch of student embeddings of shape (B, ...), where B is the batch size.
         teacher_embeddings (torch.Tensor): A batch of teacher embeddings of shape (B, ...), where B is the batch size.
+        verbose (bool): Print the statistics of every batch element (the averages are always printed).
+        chunk_size (int, optional): If given, accumulate the statistics over chunks of chunk_size values
+            (see streaming_batch_statistics) instead of reducing whole samples at once.
 
     Prints:
-        For each batch:
+        For each batch (if verbose):
             - Student mean and standard deviation
             - Teacher mean and standard deviation
             - Mean and standard deviation of the difference between student and teacher embeddings
@@ -27,183 +63,336 @@ def mean_std_difference(student_embeddings, teacher_embeddings):
             - Average difference between standard deviations across all batches
             - Average cosine similarity across all batches
     """
-    B = student_embeddings.shape[0]
+    if chunk_size is None:
+        stats = batch_statistics(student_embeddings, teacher_embeddings)
+    else:
+        stats = streaming_batch_statistics(student_embeddings, teacher_embeddings, chunk_size)
+    return summarize_statistics(stats, verbose)
+
+def summarize_statistics(stats, verbose=True):
+    """
+    Prints the per-sample statistics (see batch_statistics) and their averages over the batch.
 
-    student_means = []
-    student_stds = []
-    teacher_means = []
-    teacher_stds = []
-    cosine_sims = []
-
-    for i in range(B):
-        print(f"Batch {i}:")
-        s_mean = student_embeddings[i].mean().item()
-        s_std = student_embeddings[i].std().item()
-        t_mean = teacher_embeddings[i].mean().item()
-        t_std = teacher_embeddings[i].std().item()
-        print("  Student mean:", s_mean)
-        print("  Student std:", s_std)
-        print("  Teacher mean:", t_mean)
-        print("  Teacher std:", t_std)
-        diff = student_embeddings[i] - teacher_embeddings[i]
-        print("  Difference mean:", diff.mean().item())
-        print("  Difference std:", diff.std().item())
-        student_means.append(s_mean)
-        student_stds.append(s_std)
-        teacher_means.append(t_mean)
-        teacher_stds.append(t_std)
-
-        # Cosine similarity calculation
-        s_flat = student_embeddings[i].flatten().float()
-        t_flat = teacher_embeddings[i].flatten().float()
-        cos_sim = F.cosine_similarity(s_flat.unsqueeze(0), t_flat.unsqueeze(0)).item()
-        print("  Cosine similarity:", cos_sim)
-        cosine_sims.append(cos_sim)
-
-    mean_diff = sum(student_means) / B - sum(teacher_means) / B
-    std_diff = sum(student_stds) / B - sum(teacher_stds) / B
-    avg_cosine_sim = sum(cosine_sims) / B
+    Returns:
+        tuple: (average difference between means, average difference between stds, average cosine similarity).
+    """
+    B = len(stats["cosine_sim"])
+
+    if verbose:
+        for i in range(B):
+            print(f"Batch {i}:")
+            print("  Student mean:", stats["student_mean"][i])
+            print("  Student std:", stats["student_std"][i])
+            print("  Teacher mean:", stats["teacher_mean"][i])
+            print("  Teacher std:", stats["teacher_std"][i])
+            print("  Difference mean:", stats["diff_mean"][i])
+            print("  Difference std:", stats["diff_std"][i])
+            print("  Cosine similarity:", stats["cosine_sim"][i])
+
+    mean_diff = sum(stats["student_mean"]) / B - sum(stats["teacher_mean"]) / B
+    std_diff = sum(stats["student_std"]) / B - sum(stats["teacher_std"]) / B
+    avg_cosine_sim = sum(stats["cosine_sim"]) / B
     print(f"\033[91m\nAverage difference between means: {mean_diff}\033[0m")
     print(f"\033[91mAverage difference between stds: {std_diff}\033[0m")
     print(f"\033[94mAverage cosine similarity: {avg_cosine_sim}\033[0m")
 
     return mean_diff, std_diff, avg_cosine_sim
 
-def heatmap_sanity_check_single_channel(student_embeddings, teacher_embeddings, output_dir):
+def load_embeddings(path, mmap=False):
+    """Loads an embeddings tensor; with mmap=True it is memory-mapped on CPU and read lazily."""
+    if mmap:
+        return torch.load(path, map_location="cpu", mmap=True)
+    return torch.load(path)
+
+def streaming_batch_statistics(student_embeddings, teacher_embeddings, chunk_size=1 << 18):
+    """
+    Same statistics as batch_statistics, accumulated over chunks of about chunk_size values per sample
+    (one-pass Welford/Chan updates in float64), so that only one chunk at a time is read into memory.
+    Meant for tensors memory-mapped with torch.load(..., mmap=True) (see load_embeddings).
+
+    The chunks are slices of whole channels (dim 1) of the original tensor: unlike a reshape to (B, -1),
+    which copies a non-contiguous tensor entirely, only the current chunk is ever copied.
+
+    Args:
+        student_embeddings (torch.Tensor): A batch of student embeddings of shape (B, ...).
+        teacher_embeddings (torch.Tensor): A batch of teacher embeddings of shape (B, ...).
+        chunk_size (int): Values of each sample read per step (at least one channel).
+
+    Returns:
+        dict: See batch_statistics.
+    """
+    B = student_embeddings.shape[0]
+    if student_embeddings.dim() == 1:
+        student_embeddings, teacher_embeddings = student_embeddings[:, None], teacher_embeddings[:, None]
+    C = student_embeddings.shape[1]
+    channels_per_chunk = max(1, chunk_size // max(1, student_embeddings[0, 0].numel()))
+
+    # Running (mean, M2) of student, teacher and difference, plus the dot products for the cosine similarity
+    means = torch.zeros(3, B, dtype=torch.float64, device=student_embeddings.device)
+    m2s = torch.zeros_like(means)
+    dots = torch.zeros_like(means)  # s.t, s.s, t.t
+    count = 0
+    for start in range(0, C, channels_per_chunk):
+        s_chunk = student_embeddings[:, start:start + channels_per_chunk].reshape(B, -1).double()
+        t_chunk = teacher_embeddings[:, start:start + channels_per_chunk].reshape(B, -1).double()
+        chunk = torch.stack([s_chunk, t_chunk, s_chunk - t_chunk])  # (3, B, n)
+        n = chunk.shape[2]
+        chunk_mean = chunk.mean(dim=2)
+        chunk_m2 = ((chunk - chunk_mean.unsqueeze(2)) ** 2).sum(dim=2)
+        # Chan et al. merge of the running and the chunk statistics
+        delta = chunk_mean - means
+        total = count + n
+        means += delta * (n / total)
+        m2s += chunk_m2 + delta ** 2 * (count * n / total)
+        count = total
+        dots += torch.stack([(s_chunk * t_chunk).sum(dim=1), (s_chunk ** 2).sum(dim=1), (t_chunk ** 2).sum(dim=1)])
+
+    stds = torch.sqrt(m2s / (count - 1))
+    eps = 1e-8  # as F.cosine_similarity: each norm is clamped to eps
+    cosine_sims = dots[0] / (dots[1].sqrt().clamp_min(eps) * dots[2].sqrt().clamp_min(eps))
+    names = ["student_mean", "student_std", "teacher_mean", "teacher_std", "diff_mean", "diff_std", "cosine_sim"]
+    stats = [means[0], stds[0], means[1], stds[1], means[2], stds[2], cosine_sims]
+    return {name: stat.tolist() for name, stat in zip(names, stats)}
+
+HEATMAP_CMAP = "magma"  # perceptually uniform, close to the seaborn default used before
+HEATMAP_TITLE_HEIGHT = 20  # pixels above each map for its title
+
+def upsample_and_normalize(maps, size):
+    """
+    Upsamples a stack of single-channel maps with one interpolate call and normalizes each map to [0, 1].
+
+    Args:
+        maps (torch.Tensor): Maps of shape (B, 1, H, W).
+        size (tuple): Target (H, W).
+
+    Returns:
+        torch.Tensor: (B, H, W) float maps in [0, 1], on CPU.
+    """
+    upsampled = F.interpolate(maps.float(), size=size, mode='bilinear', align_corners=False)[:, 0]
+    low = upsampled.amin(dim=(1, 2), keepdim=True)
+    high = upsampled.amax(dim=(1, 2), keepdim=True)
+    return ((upsampled - low) / (high - low + 1e-8)).cpu()
+
+def colormap_lut(cmap_name=HEATMAP_CMAP):
+    """(256, 3) uint8 RGB table of a matplotlib colormap."""
+    return (plt.get_cmap(cmap_name)(np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+def apply_colormap(norm_maps, lut):
+    """Maps (B, H, W) values in [0, 1] to (B, H, W, 3) uint8 RGB images through the LUT."""
+    indices = (norm_maps * 255).round().clamp(0, 255).to(torch.uint8).numpy()
+    return lut[indices]
+
+def save_side_by_side(output_path, left, right, left_title, right_title):
+    """Saves two RGB images side by side, each with its title above, as a PNG."""
+    H, W = left.shape[:2]
+    gap = 10
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    # Each panel is at least as wide as its title
+    panel_W = max(W, int(max(draw.textlength(left_title), draw.textlength(right_title))) + 4)
+    canvas = Image.new("RGB", (2 * panel_W + gap, H + HEATMAP_TITLE_HEIGHT), "white")
+    draw = ImageDraw.Draw(canvas)
+    for x, image, title in [(0, left, left_title), (panel_W + gap, right, right_title)]:
+        canvas.paste(Image.fromarray(image), (x, HEATMAP_TITLE_HEIGHT))
+        draw.text((x + 2, 4), title, fill="black")
+    canvas.save(output_path)
+
+def save_heatmap_pairs(student_maps, teacher_maps, titles, output_paths, num_workers=4):
+    """
+    Renders student/teacher map pairs to side-by-side PNGs: upsampling and normalization are batched,
+    the colormap is a LUT lookup and the PNGs are encoded and written by a pool of threads.
+
+    Args:
+        student_maps (torch.Tensor): Student maps of shape (B, 1, H_s, W_s).
+        teacher_maps (torch.Tensor): Teacher maps of shape (B, 1, H_t, W_t).
+        titles (list): (student title, teacher title) of every batch element.
+        output_paths (list): Output PNG of every batch element.
+        num_workers (int): Threads writing the PNGs.
+    """
+    # Upsample to the larger resolution between student and teacher
+    size = (max(student_maps.shape[2], teacher_maps.shape[2]), max(student_maps.shape[3], teacher_maps.shape[3]))
+    lut = colormap_lut()
+    student_images = apply_colormap(upsample_and_normalize(student_maps, size), lut)
+    teacher_images = apply_colormap(upsample_and_normalize(teacher_maps, size), lut)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(save_side_by_side, path, student_images[i], teacher_images[i], *titles[i])
+                   for i, path in enumerate(output_paths)]
+        for future in futures:
+            future.result()
+
+def heatmap_sanity_check_single_channel(student_embeddings, teacher_embeddings, output_dir, num_workers=4):
     """
     Generates and saves side-by-side heatmap visualizations comparing the same randomly selected channel
     from the student and teacher embedding feature maps for all batch elements.
 
     The function upsamples both the student and teacher feature maps to the larger spatial resolution
-    between the two, normalizes them to the [0, 1] range, and plots them as heatmaps for visual inspection.
-    The resulting figures are saved to the specified output directory.
+    between the two, normalizes them to the [0, 1] range, and colors them with HEATMAP_CMAP for visual inspection.
+    The resulting images are saved to the specified output directory.
 
     Args:
         student_embeddings (torch.Tensor): Student feature maps of shape (B, C, H_s, W_s).
         teacher_embeddings (torch.Tensor): Teacher feature maps of shape (B, C, H_t, W_t).
         output_dir (str): Directory path where the heatmap images will be saved.
+        num_workers (int): Threads writing the PNGs.
 
     Returns:
         None
     """
     B, C, H_s, W_s = student_embeddings.shape
-    _, _, H_t, W_t = teacher_embeddings.shape
 
     channel_idx = random.randint(0, C - 1)
     print(f"Selected channel {channel_idx} for all batches.")
 
-    target_H = max(H_s, H_t)
-    target_W = max(W_s, W_t)
-
-    for batch_idx in range(B):
-        student_map = student_embeddings[batch_idx, channel_idx:channel_idx+1, :, :].unsqueeze(0)
-        teacher_map = teacher_embeddings[batch_idx, channel_idx:channel_idx+1, :, :].unsqueeze(0)
-
-        # Upsample to the larger resolution between student and teacher
-        student_upsampled = F.interpolate(student_map, size=(target_H, target_W), mode='bilinear', align_corners=False).squeeze()
-        teacher_upsampled = F.interpolate(teacher_map, size=(target_H, target_W), mode='bilinear', align_corners=False).squeeze()
-
-        # Normalize to [0,1]
-        student_norm = (student_upsampled - student_upsampled.min()) / (student_upsampled.max() - student_upsampled.min() + 1e-8)
-        teacher_norm = (teacher_upsampled - teacher_upsampled.min()) / (teacher_upsampled.max() - teacher_upsampled.min() + 1e-8)
-
-        fig, axs = plt.subplots(1, 2, figsize=(12, 6))
-        sns.heatmap(student_norm.cpu().numpy(), ax=axs[0], cbar=True)
-        axs[0].set_title(f"Student Embeddings - Batch {batch_idx}, Channel {channel_idx}")
-        sns.heatmap(teacher_norm.cpu().numpy(), ax=axs[1], cbar=True)
-        axs[1].set_title(f"Teacher Embeddings - Batch {batch_idx}, Channel {channel_idx}")
+    titles = [(f"Student Embeddings - Batch {batch_idx}, Channel {channel_idx}",
+               f"Teacher Embeddings - Batch {batch_idx}, Channel {channel_idx}") for batch_idx in range(B)]
+    output_paths = [os.path.join(output_dir, f"heatmap_batch{batch_idx}_channel{channel_idx}.png") for batch_idx in range(B)]
+    save_heatmap_pairs(student_embeddings[:, channel_idx:channel_idx+1], teacher_embeddings[:, channel_idx:channel_idx+1],
+                       titles, output_paths, num_workers)
 
-        plt.tight_layout()
-        output_path = os.path.join(output_dir, f"heatmap_batch{batch_idx}_channel{channel_idx}.png")
-        plt.savefig(output_path)
-        plt.close(fig)
+    print(f"Saved heatmap comparisons for {B} batches, channel {channel_idx} to {output_dir}")
 
-        print(f"Saved heatmap comparison for batch {batch_idx}, channel {channel_idx} to {output_path}")
-
-def heatmap_sanity_check_avg_all_channels(student_embeddings, teacher_embeddings, output_dir):
+def channel_mean(embeddings, chunk_size=None):
+    """
+    (B, 1, H, W) mean over the channels of (B, C, H, W) embeddings. With chunk_size, the channels are summed
+    in slices of about chunk_size values per sample, so that a memory-mapped tensor is read a slice at a time.
+    """
+    if chunk_size is None:
+        return embeddings.mean(dim=1, keepdim=True)
+    B, C, H, W = embeddings.shape
+    channels_per_chunk = max(1, chunk_size // (H * W))
+    total = torch.zeros(B, 1, H, W, dtype=torch.float64, device=embeddings.device)
+    for start in range(0, C, channels_per_chunk):
+        total += embeddings[:, start:start + channels_per_chunk].double().sum(dim=1, keepdim=True)
+    return (total / C).to(embeddings.dtype)
+
+def heatmap_sanity_check_avg_all_channels(student_embeddings, teacher_embeddings, output_dir, num_workers=4, chunk_size=None):
     """
     Generates and saves side-by-side heatmap visualizations comparing the average feature maps
     across all channels from the student and teacher embeddings for all batch elements.
 
     The function upsamples both the student and teacher average feature maps to the larger spatial resolution
-    between the two, normalizes them to the [0, 1] range, and plots them as heatmaps for visual inspection.
-    The resulting figures are saved to the specified output directory.
+    between the two, normalizes them to the [0, 1] range, and colors them with HEATMAP_CMAP for visual inspection.
+    The resulting images are saved to the specified output directory.
 
     Args:
         student_embeddings (torch.Tensor): Student feature maps of shape (B, C, H_s, W_s).
         teacher_embeddings (torch.Tensor): Teacher feature maps of shape (B, C, H_t, W_t).
         output_dir (str): Directory path where the heatmap images will be saved.
+        num_workers (int): Threads writing the PNGs.
+        chunk_size (int, optional): Average the channels chunk by chunk (see channel_mean), for memory-mapped embeddings.
 
     Returns:
         None
     """
-    B, C, H_s, W_s = student_embeddings.shape
-    _, _, H_t, W_t = teacher_embeddings.shape
-
-    target_H = max(H_s, H_t)
-    target_W = max(W_s, W_t)
-
-    for batch_idx in range(B):
-        student_map = student_embeddings[batch_idx].mean(dim=0, keepdim=True).unsqueeze(0)
-        teacher_map = teacher_embeddings[batch_idx].mean(dim=0, keepdim=True).unsqueeze(0)
-
-        # Upsample to the larger resolution between student and teacher
-        student_upsampled = F.interpolate(student_map, size=(target_H, target_W), mode='bilinear', align_corners=False).squeeze()
-        teacher_upsampled = F.interpolate(teacher_map, size=(target_H, target_W), mode='bilinear', align_corners=False).squeeze()
-
-        # Normalize to [0,1]
-        student_norm = (student_upsampled - student_upsampled.min()) / (student_upsampled.max() - student_upsampled.min() + 1e-8)
-        teacher_norm = (teacher_upsampled - teacher_upsampled.min()) / (teacher_upsampled.max() - teacher_upsampled.min() + 1e-8)
-
-        fig, axs = plt.subplots(1, 2, figsize=(12, 6))
-        sns.heatmap(student_norm.cpu().numpy(), ax=axs[0], cbar=True)
-        axs[0].set_title(f"Student Embeddings Avg All Channels - Batch {batch_idx}")
-        sns.heatmap(teacher_norm.cpu().numpy(), ax=axs[1], cbar=True)
-        axs[1].set_title(f"Teacher Embeddings Avg All Channels - Batch {batch_idx}")
-
-        plt.tight_layout()
-        output_path = os.path.join(output_dir, f"heatmap_avg_all_channels_batch{batch_idx}.png")
-        plt.savefig(output_path)
-        plt.close(fig)
-
-        print(f"Saved heatmap comparison for average all channels for batch {batch_idx} to {output_path}")
-
-student_path = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/mapanything/not_distilled" # cambia in not_distilled se vuoi quelli base
-student_embeddings_name = "student_embeddings.pt"
-teacher_path = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/sam2"
-teacher_embeddings_name = "teacher_embeddings.pt"
-dirs_to_compare = ["box_ufficio", "yokohama", "tenda_ufficio", "sedia_ufficio", "pianta", "car_drift"]
-output_dir = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/heatmap_comparisons"
-os.makedirs(output_dir, exist_ok=True)
-
-all_mean_diffs, all_std_diffs, all_cosine_sims = [], [], []
-
-for dir_name in dirs_to_compare:
-    student_embeddings_file = os.path.join(student_path, dir_name, student_embeddings_name)
-    teacher_embeddings_file = os.path.join(teacher_path, dir_name, teacher_embeddings_name)
-    output_dir_this = os.path.join(output_dir, dir_name)
-    os.makedirs(output_dir_this, exist_ok=True)
-
-    print(f"\nComparing embeddings in directory: {dir_name}")
-
-    student_embeddings = torch.load(student_embeddings_file)
-    teacher_embeddings = torch.load(teacher_embeddings_file)
+    B = student_embeddings.shape[0]
 
+    titles = [(f"Student Embeddings Avg All Channels - Batch {batch_idx}",
+               f"Teacher Embeddings Avg All Channels - Batch {batch_idx}") for batch_idx in range(B)]
+    output_paths = [os.path.join(output_dir, f"heatmap_avg_all_channels_batch{batch_idx}.png") for batch_idx in range(B)]
+    save_heatmap_pairs(channel_mean(student_embeddings, chunk_size), channel_mean(teacher_embeddings, chunk_size),
+                       titles, output_paths, num_workers)
 
-    mean_diff, std_diff, avg_cosine_sim = mean_std_difference(student_embeddings, teacher_embeddings)
+    print(f"Saved heatmap comparisons for average all channels for {B} batches to {output_dir}")
 
-    all_mean_diffs.append(mean_diff)
-    all_std_diffs.append(std_diff)
-    all_cosine_sims.append(avg_cosine_sim)
+def find_dirs_to_compare(student_path, student_embeddings_name, teacher_path, teacher_embeddings_name):
+    """Sorted names of the subdirectories having both the student and the teacher embeddings file."""
+    return sorted(
+        d for d in os.listdir(student_path)
+        if os.path.isfile(os.path.join(student_path, d, student_embeddings_name))
+        and os.path.isfile(os.path.join(teacher_path, d, teacher_embeddings_name))
+    )
 
-    # heatmap_sanity_check_single_channel(student_embeddings, teacher_embeddings, output_dir_this)
-    # heatmap_sanity_check_avg_all_channels(student_embeddings, teacher_embeddings, output_dir_this)
+def prefetch_embeddings(pairs, mmap=False, depth=2):
+    """
+    Yields (dir_name, student_embeddings, teacher_embeddings) for every (dir_name, student_file, teacher_file),
+    in order, loading the next depth directories on background threads while the current one is compared.
 
-# Print overall averages after all directories
-overall_mean_diff = sum(all_mean_diffs) / len(all_mean_diffs)
-overall_std_diff = sum(all_std_diffs) / len(all_std_diffs)
-overall_cosine_sim = sum(all_cosine_sims) / len(all_cosine_sims)
-print("\n\033[92m=== Overall Results Across All Directories ===\033[0m")
-print(f"\033[91mAverage difference between means (overall): {overall_mean_diff}\033[0m")
-print(f"\033[91mAverage difference between stds (overall): {overall_std_diff}\033[0m")
-print(f"\033[94mAverage cosine similarity (overall): {overall_cosine_sim}\033[0m")
\ No newline at end of file
+    Args:
+        pairs (list): (dir_name, student_file, teacher_file) tuples.
+        mmap (bool): Memory-map the tensors (see load_embeddings).
+        depth (int): Directories loaded ahead (each one holds both tensors in memory). 0 loads synchronously.
+    """
+    def load(pair):
+        dir_name, student_file, teacher_file = pair
+        return dir_name, load_embeddings(student_file, mmap), load_embeddings(teacher_file, mmap)
+
+    if depth <= 0:
+        for pair in pairs:
+            yield load(pair)
+        return
+
+    pairs = iter(pairs)
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque(executor.submit(load, pair) for _, pair in zip(range(depth), pairs))
+        while pending:
+            loaded = pending.popleft().result()
+            next_pair = next(pairs, None)
+            if next_pair is not None:
+                pending.append(executor.submit(load, next_pair))
+            yield loaded
+            del loaded
+
+def write_results_table(results_path, rows):
+    """Writes the per-directory metrics and their average to a CSV file."""
+    with open(results_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["dir_name", "mean_diff", "std_diff", "cosine_sim"])
+        writer.writerows(rows)
+        if rows:
+            writer.writerow(["overall"] + [sum(row[k] for row in rows) / len(rows) for k in (1, 2, 3)])
+
+if __name__ == "__main__":
+    student_path = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/mapanything/not_distilled" # cambia in not_distilled se vuoi quelli base
+    student_embeddings_name = "student_embeddings.pt"
+    teacher_path = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/sam2"
+    teacher_embeddings_name = "teacher_embeddings.pt"
+    # None: every subdirectory of student_path with both embedding files
+    # (e.g. ["box_ufficio", "yokohama", "tenda_ufficio", "sedia_ufficio", "pianta", "car_drift"])
+    dirs_to_compare = None
+    verbose_batches = True  # print the statistics of every batch element, not only the averages
+    streaming = False       # memory-map the .pt files and accumulate the statistics chunk by chunk (files larger than RAM)
+    stream_chunk_size = 1 << 18  # values per sample read at each step in streaming mode
+    prefetch_depth = 2      # directories loaded ahead on background threads while the current one is compared
+    save_heatmaps = True    # student/teacher heatmaps (random channel and channel average) of every batch element
+    output_dir = "/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/distillation/heatmap_comparisons"
+    results_path = os.path.join(output_dir, "comparison_results.csv")
+    os.makedirs(output_dir, exist_ok=True)
+
+    if dirs_to_compare is None:
+        dirs_to_compare = find_dirs_to_compare(student_path, student_embeddings_name, teacher_path, teacher_embeddings_name)
+    print(f"Comparing {len(dirs_to_compare)} directories")
+
+    pairs = [(dir_name,
+              os.path.join(student_path, dir_name, student_embeddings_name),
+              os.path.join(teacher_path, dir_name, teacher_embeddings_name)) for dir_name in dirs_to_compare]
+    results = []
+
+    for dir_name, student_embeddings, teacher_embeddings in prefetch_embeddings(pairs, mmap=streaming, depth=prefetch_depth):
+        output_dir_this = os.path.join(output_dir, dir_name)
+        os.makedirs(output_dir_this, exist_ok=True)
+
+        print(f"\nComparing embeddings in directory: {dir_name}")
+
+        mean_diff, std_diff, avg_cosine_sim = mean_std_difference(student_embeddings, teacher_embeddings, verbose=verbose_batches,
+                                                                  chunk_size=stream_chunk_size if streaming else None)
+        results.append([dir_name, mean_diff, std_diff, avg_cosine_sim])
+
+        if save_heatmaps:
+            heatmap_sanity_check_single_channel(student_embeddings, teacher_embeddings, output_dir_this)
+            heatmap_sanity_check_avg_all_channels(student_embeddings, teacher_embeddings, output_dir_this,
+                                                  chunk_size=stream_chunk_size if streaming else None)
+
+    write_results_table(results_path, results)
+    print(f"\nResults saved to {results_path}")
+
+    # Print overall averages after all directories
+    if not results:
+        print("\nNo directories compared: no overall results.")
+    else:
+        overall_mean_diff = sum(row[1] for row in results) / len(results)
+        overall_std_diff = sum(row[2] for row in results) / len(results)
+        overall_cosine_sim = sum(row[3] for row in results) / len(results)
+        print("\n\033[92m=== Overall Results Across All Directories ===\033[0m")
+        print(f"\033[91mAverage difference between means (overall): {overall_mean_diff}\033[0m")
+        print(f"\033[91mAverage difference between stds (overall): {overall_std_diff}\033[0m")
+        print(f"\033[94mAverage cosine similarity (overall): {overall_cosine_sim}\033[0m")
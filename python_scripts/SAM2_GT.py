@@ -5,9 +5,34 @@ import numpy as np
 import colorsys
 import json
 from PIL import Image
-from glob import glob
-import csv
+import re
+import shutil
+from collections import defaultdict
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from gt_mask_cache import build_gt_cache
+from results_store import ResultsWriter, merge_results, export_csv, read_results
+from bench_manifest import Manifest
+from prefetch import prefetch
+from mask_store import STORE_NAME, PackedMasks, open_video_segments
+from bench_trace import Tracer
+
+# Bump when the IoU computation changes: every video is recomputed
+METRIC_VERSION = 1
+
+# SAM masks are saved as frame_XXXX_obj_YY_mask.png
+SAM_MASK_PATTERN = re.compile(r"frame_(\d+)_obj_(\d+)_mask\.png$")
+
+# SAM2 also saves all the masks of a video in one file: {frame index: {object ID: (1, H, W) bool mask}}.
+# It is read through its bit-packed store (see mask_store.py), which can also be kept without the original file.
+VIDEO_SEGMENTS_NAMES = ("video_segments.npy", "video_segments.pkl", f"{STORE_NAME}.npy")
+
+# Frames (GT + predicted masks) decoded ahead on a thread pool while the current frame is scored
+PREFETCH_DEPTH = 8  # 0 disables the prefetch
+PREFETCH_MAX_MB = 512  # memory cap of the frames loaded ahead, shared by all the worker processes
+PREFETCH_THREADS = 4  # loader threads, shared by all the worker processes (at least 1 per worker)
+
+NO_TRACE = Tracer()  # tracing disabled
 
 # this function is used in kubric to generate color palettes based on the TOTAL numer of objects in the video (not just visible in the first frame)
 def hls_palette(n_colors, first_hue=0.01, lightness=.5, saturation=.7):
@@ -27,60 +52,138 @@ def calculate_iou(mask1, mask2):
         return 1.0 if intersection == 0 else 0.0
     return intersection / union
 
-def benchmark_frame(gt_mask_path, sam_masks_dir, color_to_id_map, video_name, frame_idx):
+def decode_label_map(gt_id_map, gt_ids):
     """
-    Calculates the mIoU for a single frame and saves the IoU for each object in the CSV.
+    Decodes a GT instance-ID map into the label map of the objects tracked by SAM with a single lookup.
+
+    Args:
+        gt_id_map (np.ndarray): (H, W) GT instance IDs (see gt_mask_cache).
+        gt_ids (list): IDs of the tracked objects, in evaluation order.
+
+    Returns:
+        np.ndarray: (H, W) label map, 0 for background/untracked pixels and k+1 for the pixels of gt_ids[k].
+    """
+    lut = np.zeros(max(int(gt_id_map.max()), max(gt_ids, default=0)) + 1, dtype=np.int64)
+    for k, gt_id in enumerate(gt_ids):
+        lut[gt_id] = k + 1
+    return lut[gt_id_map]
+
+def compute_ious(label_map, pred_stack, gt_area=None):
+    """
+    Computes the IoU of every tracked object at once from a label map and a stack of predicted masks.
+
+    Args:
+        label_map (np.ndarray): (H, W) label map as returned by decode_label_map.
+        pred_stack (np.ndarray): (K, H*W) boolean stack, row k is the predicted mask of object k+1.
+        gt_area (np.ndarray, optional): (K,) GT pixel count per object, computed if not given.
+
+    Returns:
+        np.ndarray: (K,) IoU per object (same convention as calculate_iou).
+    """
+    flat = label_map.ravel()
+    n_objects = pred_stack.shape[0]
+    if gt_area is None:
+        gt_area = np.bincount(flat, minlength=n_objects + 1)[1:]
+    # For each pixel, check the predicted mask of the GT object it belongs to
+    hit = pred_stack[np.maximum(flat - 1, 0), np.arange(flat.size)] & (flat > 0)
+    intersection = np.bincount(flat[hit], minlength=n_objects + 1)[1:]
+    union = gt_area + np.count_nonzero(pred_stack, axis=1) - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ious = intersection / union
+    return np.where(union == 0, np.where(intersection == 0, 1.0, 0.0), ious)
+
+def index_sam_masks(sam_masks_dir):
+    """
+    Scans the SAM mask directory once and indexes the frame_XXXX_obj_YY_mask.png files.
 
     Args:
-        gt_mask_path (str): Path to the GT RGB mask.
         sam_masks_dir (str): Path to the folder with masks predicted by SAM.
+
+    Returns:
+        dict: frame index -> {object ID -> mask path}.
+    """
+    mask_index = defaultdict(dict)
+    with os.scandir(sam_masks_dir) as entries:
+        for entry in entries:
+            match = SAM_MASK_PATTERN.match(entry.name)
+            if match:
+                mask_index[int(match.group(1))][int(match.group(2))] = entry.path
+    return dict(mask_index)
+
+def find_video_segments(sam_results_dir):
+    """Returns the path of the video_segments file in the SAM results folder of a video, None if there is none."""
+    for name in VIDEO_SEGMENTS_NAMES:
+        path = os.path.join(sam_results_dir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def read_pred_mask(entry, segments=None):
+    """Binarized (H, W) predicted mask from an index entry: the path of a SAM mask PNG or a row of the packed segments."""
+    if isinstance(entry, str):
+        return np.array(Image.open(entry)) > 0
+    return segments.mask(entry)
+
+def benchmark_frame(gt_id_map, pred_masks, color_to_id_map, video_name, frame_idx, csv_writer, tracer=NO_TRACE):
+    """
+    Calculates the mIoU for a single frame and saves the IoU for each object in the CSV.
+
+    Args:
+        gt_id_map (np.ndarray): (H, W) GT instance IDs of the frame, None if the GT mask is missing.
+        pred_masks (dict): Object ID -> (H, W) mask predicted by SAM for this frame (see load_frame),
+                           None if SAM did not produce any mask for this frame.
         color_to_id_map (dict): Dictionary mapping color tuples to integer IDs.
         video_name (str): Name of the video.
         frame_idx (int): Frame index.
+        csv_writer (csv.writer or results_store.ResultsWriter): Writer receiving the per-object rows.
+        tracer (Tracer, optional): Receives the missing-mask messages and event counts.
 
     Returns:
         float: The mIoU for this frame.
     """
-    try:
-        # Load the ground truth RGB mask as a numpy array
-        gt_rgb_mask = np.array(Image.open(gt_mask_path).convert("RGB"))
-        # Find all unique colors in the GT mask (each color corresponds to an object)
-        unique_colors = np.unique(gt_rgb_mask.reshape(-1, 3), axis=0)
-        # Find all SAM mask files for this frame
-        sam_mask_files = [f for f in glob(f"{sam_masks_dir}*.png") if os.path.basename(f).startswith(os.path.basename(sam_masks_dir))]
-        if not sam_mask_files:
-            # If SAM did not produce any masks and there are objects in GT, IoU is 0 for all
-            for color_tuple, gt_id in color_to_id_map.items():
-                csv_writer.writerow([video_name, frame_idx, gt_id, 0.0])
-            return 0.0 if color_to_id_map else 1.0
-    except FileNotFoundError:
-        # If the GT mask or SAM mask directory is missing, skip this frame
-        print(f"Warning: File not found for {gt_mask_path} or {sam_masks_dir}, skipping frame.")
+    if gt_id_map is None:
+        # If the GT mask is missing, skip this frame
+        tracer.debug("GT mask not found for frame %05d, skipping frame.", frame_idx)
+        tracer.count("frame skipped, GT mask missing")
         return None
+    if pred_masks is None:
+        # If SAM did not produce any masks and there are objects in GT, IoU is 0 for all
+        tracer.debug("No predicted masks for frame %04d", frame_idx)
+        tracer.count("frame without predicted masks")
+        for color_tuple, gt_id in color_to_id_map.items():
+            csv_writer.writerow([video_name, frame_idx, gt_id, 0.0])
+        return 0.0 if color_to_id_map else 1.0
 
-    best_ious_for_each_gt_instance = []
+    # Decode the GT frame once into a label map (k+1 = k-th object tracked by SAM)
+    gt_ids = list(color_to_id_map.values())
+    label_map = decode_label_map(gt_id_map, gt_ids)
+    gt_area = np.bincount(label_map.ravel(), minlength=len(gt_ids) + 1)[1:]
 
-    # For each object tracked by SAM (using color_to_id_map)
-    for color_tuple, gt_id in color_to_id_map.items():
-        color_array = np.array(color_tuple)
-        # Create a binary mask for the current object in the GT mask
-        gt_binary_mask = np.all(gt_rgb_mask == color_array, axis=-1)
-        if gt_binary_mask.sum() == 0:
+    # Pack the predicted masks of the objects present in the GT into a single stack
+    pred_stack = np.zeros((len(gt_ids), label_map.size), dtype=bool)
+    pred_missing = np.zeros(len(gt_ids), dtype=bool)
+    for k, gt_id in enumerate(gt_ids):
+        if gt_area[k] == 0:
             # If the object is not present in the GT mask for this frame, skip it
             continue
-        # Build the path to the predicted mask for this object
-        pred_mask_path = sam_masks_dir + f"{gt_id}_mask.png"
-        if not os.path.exists(pred_mask_path):
+        # Look up the predicted mask for this object
+        pred_mask = pred_masks.get(gt_id)
+        if pred_mask is None:
             # If the predicted mask is missing, IoU is 0
-            print(f"Predicted mask not found: {pred_mask_path}")
-            iou = 0.0
-            best_ious_for_each_gt_instance.append(iou)
-            csv_writer.writerow([video_name, frame_idx, gt_id, iou])
+            tracer.debug("Predicted mask not found: frame %04d, object %d", frame_idx, gt_id)
+            tracer.count("predicted mask missing (IoU 0)")
+            pred_missing[k] = True
+            continue
+        pred_stack[k] = pred_mask.ravel()
+
+    # Intersection and union of every object in a single pass
+    ious = compute_ious(label_map, pred_stack, gt_area)
+
+    best_ious_for_each_gt_instance = []
+    for k, gt_id in enumerate(gt_ids):
+        if gt_area[k] == 0:
             continue
-        # Load the predicted mask and binarize it
-        pred_mask = np.array(Image.open(pred_mask_path)) > 0
-        # Calculate IoU between GT and predicted mask
-        iou = calculate_iou(gt_binary_mask, pred_mask)
+        iou = 0.0 if pred_missing[k] else ious[k]
         best_ious_for_each_gt_instance.append(iou)
         # Write the IoU result to the CSV file
         csv_writer.writerow([video_name, frame_idx, gt_id, iou])
@@ -93,21 +196,54 @@ def benchmark_frame(gt_mask_path, sam_masks_dir, color_to_id_map, video_name, fr
     frame_miou = sum(best_ious_for_each_gt_instance) / len(best_ious_for_each_gt_instance)
     return frame_miou
 
-# Prepare CSV file for writing IoU results
-csv_output_path = "iou_sam2.csv"
-csv_file = open(csv_output_path, "w", newline="")
-csv_writer = csv.writer(csv_file)
-csv_writer.writerow(["video_name", "frame", "object_id", "iou"])
+def load_frame(gt_labels, gt_row, frame_masks, tracked_ids, segments=None):
+    """
+    Loads the GT instance IDs and the binarized SAM masks of a frame (I/O part of benchmark_frame).
+
+    Args:
+        gt_labels (np.ndarray): Memory-mapped (T, H, W) GT instance IDs of the video.
+        gt_row (int): Row of the frame in gt_labels, None if the GT mask is missing.
+        frame_masks (dict): Object ID -> mask predicted by SAM for this frame, as PNG path or packed row (see read_pred_mask).
+        tracked_ids (set): IDs of the objects tracked by SAM; masks of other objects are not read.
+        segments (mask_store.PackedMasks, optional): Packed segments the rows refer to.
+
+    Returns:
+        tuple: (gt_id_map or None, {object ID: (H, W) bool mask} or None if SAM produced no mask).
+    """
+    gt_id_map = np.array(gt_labels[gt_row]) if gt_row is not None else None
+    if gt_id_map is None or not frame_masks:
+        return gt_id_map, None
+    pred_masks = {obj_id: read_pred_mask(entry, segments)
+                  for obj_id, entry in frame_masks.items() if obj_id in tracked_ids}
+    return gt_id_map, pred_masks
 
-# video_names contains all the video in base_dir starting with "video_"
-base_dir = "/scratch2/nico/examples/kubric"
-video_names = [d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d)) and d.startswith("video_")]
+def video_inputs(base_dir, video_name, source="auto"):
+    """Input files/directories of a video, recorded in the manifest to detect changes."""
+    sam_results_dir = f"{base_dir}/results/sam2/{video_name}"
+    segments_path = find_video_segments(sam_results_dir) if source != "png" else None
+    return [
+        segments_path if segments_path is not None else f"{sam_results_dir}/sam_masks",
+        f"{base_dir}/{video_name}/gt_masks",
+        f"{base_dir}/{video_name}/metadata.json",
+    ]
 
-for video_name in video_names:
-    print(f"Processing video: {video_name}")
+def prepare_video(base_dir, video_name, source="auto"):
+    """
+    Reads the metadata of a video and builds the color_to_id_map of the objects tracked by SAM.
+
+    Args:
+        base_dir (str): Kubric folder with the videos and results/sam2.
+        video_name (str): Name of the video.
+        source (str): Predictions to read: "png" (sam_masks/frame_XXXX_obj_YY_mask.png), "segments"
+                      (video_segments.npy/.pkl, no PNG decoding) or "auto" (segments if present, else png).
 
+    Returns:
+        dict: frames, color_to_id_map, mask_index (frame index -> {object ID -> PNG path or packed row}),
+              segments_path (packed store, None for PNGs), gt_cache_path and gt_frame_rows
+              (see gt_mask_cache.build_gt_cache) of the video.
+    """
     # Define paths
-    sam_masks_dir = f"{base_dir}/results/sam2/{video_name}/sam_masks"
+    sam_results_dir = f"{base_dir}/results/sam2/{video_name}"
     gt_masks_dir = f"{base_dir}/{video_name}/gt_masks"
     metadata_path = f"{base_dir}/{video_name}/metadata.json"
 
@@ -126,35 +262,193 @@ for video_name in video_names:
     # print(f"Generated color palette with {len(palette)} colors (the first is background).")
     # print("Colori nella palette:", palette)
 
+    # Decode the GT masks once into the persistent cache (reused as long as the PNGs do not change)
+    gt_cache_path, gt_frame_rows = build_gt_cache(gt_masks_dir, palette)
+
+    # Masks predicted by SAM: rows of the packed video_segments, or indexed with a single scan of the PNG folder
+    segments_path = find_video_segments(sam_results_dir) if source != "png" else None
+    if segments_path is not None:
+        segments = open_video_segments(segments_path)
+        segments_path = segments.path
+        mask_index = {frame_idx: segments.rows_of(frame_idx) for frame_idx in segments.frames()}
+    elif source == "segments":
+        raise FileNotFoundError(f"No {' or '.join(VIDEO_SEGMENTS_NAMES)} in {sam_results_dir}")
+    else:
+        mask_index = index_sam_masks(f"{sam_results_dir}/sam_masks")
+
     # Extract the object IDs tracked by SAM in the first frame
     # and create a color_to_id_map for those objects only (will be used to retrieve the GT masks)
     sam_object_ids = set()
     color_to_id_map = {}
-    for file_name in os.listdir(sam_masks_dir):
-        if file_name.startswith("frame_0000_obj_") and file_name.endswith("_mask.png"):
-            obj_id = int(file_name.split("_")[3])
-            sam_object_ids.add(obj_id)
-            if obj_id < len(palette):
-                color_tuple = tuple(palette[obj_id])
-                color_to_id_map[color_tuple] = obj_id
+    for obj_id in mask_index.get(0, {}):
+        sam_object_ids.add(obj_id)
+        if obj_id < len(palette):
+            color_tuple = tuple(palette[obj_id])
+            color_to_id_map[color_tuple] = obj_id
     # print(f"SAM tracked {len(sam_object_ids)} objects in the first frame.")
     # print(f"SAM object IDs: {sam_object_ids}")
     # print(f"Color to ID map for SAM-tracked objects: {color_to_id_map}")
 
-    # for each frame, load the complete GT mask and extrapolate the masks for the objects tracked by sam
+    return {
+        "frames": frames,
+        "color_to_id_map": color_to_id_map,
+        "mask_index": mask_index,
+        "segments_path": segments_path,
+        "gt_cache_path": gt_cache_path,
+        "gt_frame_rows": gt_frame_rows,
+    }
+
+def worker_prefetch_options(num_workers):
+    """prefetch arguments of each of num_workers processes: the thread and memory budgets are split among them."""
+    return {"depth": PREFETCH_DEPTH, "max_bytes": (PREFETCH_MAX_MB << 20) // num_workers,
+            "num_threads": max(PREFETCH_THREADS // num_workers, 1)}
+
+def evaluate_frames(video_name, video, frame_start, frame_end, shard_path, trace_options=None, prefetch_options=None):
+    """
+    Benchmarks the frames [frame_start, frame_end) of a video and writes their rows to a Parquet shard.
+
+    Runs in a worker process: every call owns its shard, so workers never share a writer.
+    The events are counted by a tracer local to the call (built from trace_options, the Tracer arguments)
+    and returned, to be summed up by the main process. prefetch_options are the prefetch arguments of the
+    worker (see worker_prefetch_options, default: the whole budget).
+
+    Returns:
+        tuple: (the mIoU of every frame that was not skipped, in frame order; Counter of the traced events)
+    """
+    tracer = Tracer(**(trace_options or {}))
     miou_values = []
-    for frame_idx in range(frames):
-        gt_mask_path = os.path.join(gt_masks_dir, f"segmentation_{frame_idx:05d}.png")
-        frame_sam_masks_dir = os.path.join(sam_masks_dir, f"frame_{frame_idx:04d}_obj_")
-        frame_miou = benchmark_frame(gt_mask_path, frame_sam_masks_dir, color_to_id_map, video_name, frame_idx)
-        if frame_miou is not None:
-            miou_values.append(frame_miou)
-        else:
-            print(f"Frame {frame_idx:05d}: skipped due to missing data.")
+    # Memory-mapped GT instance IDs of the whole video
+    gt_labels = np.load(video["gt_cache_path"], mmap_mode="r")
+    # Memory-mapped packed masks predicted by SAM (None when reading the PNGs)
+    segments = PackedMasks(video["segments_path"]) if video["segments_path"] is not None else None
+    tracked_ids = set(video["color_to_id_map"].values())
+
+    def loader(frame_idx):
+        return load_frame(gt_labels, video["gt_frame_rows"].get(frame_idx),
+                          video["mask_index"].get(frame_idx, {}), tracked_ids, segments)
 
-    # Calculate overall mIoU
-    if miou_values:
-        overall_miou = sum(miou_values) / len(miou_values)
-        print(f"Overall mIoU for video {video_name}: {overall_miou:.4f}")
+    with ResultsWriter(shard_path, "iou") as shard_writer:
+        # for each frame, load the complete GT mask and extrapolate the masks for the objects tracked by sam;
+        # the next frames are decoded on background threads while the current one is scored
+        frames = prefetch(loader, range(frame_start, frame_end), **(prefetch_options or worker_prefetch_options(1)))
+        for frame_idx, (gt_id_map, pred_masks) in frames:
+            frame_miou = benchmark_frame(gt_id_map, pred_masks, video["color_to_id_map"], video_name, frame_idx, shard_writer, tracer)
+            if frame_miou is not None:
+                miou_values.append(frame_miou)
+    return miou_values, tracer.counts
+
+def frame_chunk_tasks(video_name, video, chunk_size, shards_dir, trace_options=None, prefetch_options=None):
+    """
+    Splits a prepared video (see prepare_video) in chunks of frames, each one written to its own shard.
+
+    Returns:
+        list: evaluate_frames argument tuples, one per chunk.
+    """
+    tasks = []
+    for start in range(0, video["frames"], chunk_size):
+        end = min(start + chunk_size, video["frames"])
+        # Ship to the worker only the part of the mask index covering its chunk
+        chunk = dict(video, mask_index={i: video["mask_index"][i] for i in range(start, end) if i in video["mask_index"]},
+                     gt_frame_rows={i: video["gt_frame_rows"][i] for i in range(start, end) if i in video["gt_frame_rows"]})
+        tasks.append((video_name, chunk, start, end, os.path.join(shards_dir, f"{video_name}_{start:05d}.parquet"),
+                      trace_options, prefetch_options))
+    return tasks
+
+# --- MAIN SCRIPT ---
+
+if __name__ == "__main__":
+    # video_names contains all the video in base_dir starting with "video_"
+    base_dir = "/scratch2/nico/examples/kubric"
+    results_output_path = "iou_sam2.parquet"
+    manifest_path = "iou_sam2.manifest.json"   # inputs of every computed video: unchanged videos are not recomputed
+    EXPORT_CSV = True                       # also export the results to iou_sam2.csv
+    shards_dir = "iou_sam2_shards"          # per-worker Parquet shards, merged into results_output_path at the end
+    # CPUs allocated to this job (os.cpu_count() counts every core of the node, also under Slurm); 1 = sequential
+    NUM_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    FRAME_CHUNK_SIZE = 60                   # long videos are split in chunks of frames across workers
+    PREDICTION_SOURCE = "auto"              # "png", "segments" (video_segments.npy/.pkl) or "auto" (segments if present)
+    TRACE_LEVEL = "info"                    # "info" (full speed) or "debug" (per-frame missing-mask lines)
+    COUNT_EVENTS = True                     # print a summary of the missing-mask events
+    trace_options = {"level": TRACE_LEVEL, "count_events": COUNT_EVENTS}
+    tracer = Tracer(**trace_options)
+    prefetch_options = worker_prefetch_options(NUM_WORKERS)
+
+    video_names = sorted(d for d in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, d)) and d.startswith("video_"))
+    # Start from an empty shards directory (a crashed run may have left stale shards)
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    os.makedirs(shards_dir)
+
+    executor = ProcessPoolExecutor(max_workers=NUM_WORKERS) if NUM_WORKERS > 1 else None
+    map_videos = executor.map if executor is not None else map
+
+    # Find the videos whose inputs did not change since the last run (only if its results are still there);
+    # the inputs of the videos are hashed in parallel
+    manifest = Manifest(manifest_path, METRIC_VERSION)
+    if not os.path.exists(results_output_path):
+        manifest.prune([])
+    inputs = [video_inputs(base_dir, video_name, PREDICTION_SOURCE) for video_name in video_names]
+    fingerprints = dict(zip(video_names, map_videos(manifest.fingerprint, video_names, inputs)))
+    unchanged = [video_name for video_name in video_names if manifest.is_current(video_name, fingerprints[video_name])]
+    changed = [video_name for video_name in video_names if video_name not in unchanged]
+
+    # Prepare every (new or changed) video (GT mask cache, packed segments) and split it in chunks of frames.
+    # With workers, the videos are prepared in parallel and the chunks of a video are submitted as soon as it is ready
+    tasks = {}
+    futures = {}
+    if executor is not None:
+        prepared = {executor.submit(prepare_video, base_dir, video_name, PREDICTION_SOURCE): video_name for video_name in changed}
+        for future in as_completed(prepared):
+            video_name = prepared[future]
+            tasks[video_name] = frame_chunk_tasks(video_name, future.result(), FRAME_CHUNK_SIZE, shards_dir, trace_options, prefetch_options)
+            futures[video_name] = [executor.submit(evaluate_frames, *task) for task in tasks[video_name]]
     else:
-        print("No valid frames processed, overall mIoU cannot be calculated.")
+        for video_name in changed:
+            video = prepare_video(base_dir, video_name, PREDICTION_SOURCE)
+            tasks[video_name] = frame_chunk_tasks(video_name, video, FRAME_CHUNK_SIZE, shards_dir, trace_options, prefetch_options)
+
+    # The rows of the unchanged videos are carried over from the previous results
+    shard_paths = []
+    if unchanged:
+        kept_path = os.path.join(shards_dir, "unchanged.parquet")
+        previous = read_results(results_output_path, videos=unchanged)
+        with ResultsWriter(kept_path, "iou") as kept_writer:
+            kept_writer.write_dataframe(previous)
+        shard_paths.append(kept_path)
+
+    for video_name in video_names:
+        if video_name in unchanged:
+            print(f"Processing video: {video_name} (unchanged, previous results)")
+            overall_miou = manifest.summary(video_name)["miou"]
+        else:
+            print(f"Processing video: {video_name}")
+            miou_values = []
+            if executor is not None:
+                chunk_results = (future.result() for future in futures[video_name])
+            else:
+                chunk_results = (evaluate_frames(*task) for task in tasks[video_name])
+            for chunk_miou_values, chunk_counts in chunk_results:
+                miou_values.extend(chunk_miou_values)
+                tracer.counts.update(chunk_counts)
+            overall_miou = sum(miou_values) / len(miou_values) if miou_values else None
+            manifest.update(video_name, fingerprints[video_name], {"miou": overall_miou})
+
+        # Calculate overall mIoU
+        if overall_miou is not None:
+            print(f"Overall mIoU for video {video_name}: {overall_miou:.4f}")
+        else:
+            print("No valid frames processed, overall mIoU cannot be calculated.")
+
+    if executor is not None:
+        executor.shutdown()
+
+    # Merge the IoU results of all the workers, sorted by (video_name, frame, object_id)
+    shard_paths += [task[4] for video_tasks in tasks.values() for task in video_tasks]
+    if shard_paths:
+        merge_results(shard_paths, results_output_path)
+        if EXPORT_CSV:
+            export_csv(results_output_path)
+    manifest.prune(video_names)
+    manifest.save()
+    shutil.rmtree(shards_dir)
+
+    tracer.summary()
@@ -4,16 +4,165 @@
 # EPE-3D: for each video (or frame and then average), compute the distance between the predicted 3D position and the GT 3D position for each object
 
 import numpy as np
-from PIL import Image
 import os
+import json
 from glob import glob
 import matplotlib.pyplot as plt
-import csv
-from collections import defaultdict
+from scipy.ndimage import distance_transform_edt
+from bench_trace import Tracer
+from gt_mask_cache import load_gt_label_maps
+from track_store import load_tracks
+from results_store import ResultsWriter, export_csv, read_results
+from bench_manifest import Manifest
+from prefetch import prefetch
 
-def calculate_tracking_consistency(video_path, spatrack2_path):
+NO_TRACE = Tracer()  # tracing disabled
+
+# Frames (GT mask + predicted 2D tracks) read ahead on a thread pool while the current frame is scored
+PREFETCH_DEPTH = 8  # 0 disables the prefetch
+PREFETCH_MAX_MB = 256  # memory cap of the frames loaded ahead
+
+# Bump when the metrics change: every video is recomputed
+METRIC_VERSION = 3
+
+# Predicted 3D tracks used by EPE-3D: (T, N, 3) positions. SpaTrackerV2's inference.py saves them as "coords"
+# in result.npz, moved to the world frame of its own estimated poses (the first camera, OpenCV axes), which is
+# not the Kubric world frame
+TRACKS_3D_NAME = "result.npz"
+TRACKS_3D_KEY = "coords"  # None = the array named as the file, or the first one
+# Alignment of the predicted displacements to the GT ones before computing the EPE:
+# - "similarity": per-video rotation + scale fitted by least squares (Umeyama), for predictions in any frame
+# - "scale": only the median ratio of GT to predicted displacement norms (predictions already in Kubric axes)
+# - None: no alignment
+ALIGNMENT = "similarity"
+
+# Radius search around points whose GT ID does not match: score given by the radius at which the ID is found
+MAX_SEARCH_RADIUS = 5
+SCORE_TABLE = {1: 0.99, 2: 0.9, 3: 0.8, 4: 0.5, 5: 0.30}  # tune these values
+
+def map_to_gt(points, scale_x, scale_y):
+    """Rescales (N, >=2) predicted points to integer GT pixel coordinates (truncated like int())."""
+    x_mapped = np.trunc(points[:, 0] * scale_x).astype(np.int64)
+    y_mapped = np.trunc(points[:, 1] * scale_y).astype(np.int64)
+    return x_mapped, y_mapped
+
+def lookup_gt_ids(gt_instance_mask, x_mapped, y_mapped):
+    """Gathers the GT IDs at the given pixels, 0 for pixels outside the mask."""
+    H, W = gt_instance_mask.shape[:2]
+    inside = (x_mapped >= 0) & (x_mapped < W) & (y_mapped >= 0) & (y_mapped < H)
+    ids = np.zeros(len(x_mapped), dtype=np.int64)
+    ids[inside] = gt_instance_mask[y_mapped[inside], x_mapped[inside]]
+    return ids
+
+def object_distance_maps(gt_instance_mask, obj_ids, pad):
+    """
+    Computes, once per GT frame, the Euclidean distance transform of each object's instance mask.
+
+    Args:
+        gt_instance_mask (np.ndarray): (H, W) GT instance IDs.
+        obj_ids (np.ndarray): IDs of the objects to compute.
+        pad (int): Border added around the frame, so that locations up to pad pixels outside it can be looked up.
+
+    Returns:
+        np.ndarray: (K, H + 2*pad, W + 2*pad) distance from each (padded) pixel to the nearest pixel of obj_ids[k]
+                    (inf if the object is not in the frame).
+    """
+    padded = np.pad(gt_instance_mask, pad)
+    dist_maps = np.full((len(obj_ids),) + padded.shape, np.inf)
+    for k, obj_id in enumerate(obj_ids):
+        not_obj = padded != obj_id
+        if obj_id != 0 and not not_obj.all():
+            dist_maps[k] = distance_transform_edt(not_obj)
+    return dist_maps
+
+def radius_search(gt_instance_mask, x_mapped, y_mapped, target_ids, max_radius=MAX_SEARCH_RADIUS):
+    """
+    Finds, for each point, the smallest radius r <= max_radius at which a pixel of its target ID lies
+    (dx^2 + dy^2 <= r^2 around the mapped location). Returns 0 where the ID is not found.
+
+    Uses a distance transform per object, so the cost does not depend on max_radius.
+    """
+    obj_ids, obj_index = np.unique(target_ids, return_inverse=True)
+    dist_maps = object_distance_maps(gt_instance_mask, obj_ids, max_radius)
+    Hp, Wp = dist_maps.shape[1:]
+    px, py = x_mapped + max_radius, y_mapped + max_radius
+    inside = (px >= 0) & (px < Wp) & (py >= 0) & (py < Hp)
+    dist = np.full(len(target_ids), np.inf)
+    dist[inside] = dist_maps[obj_index[inside], py[inside], px[inside]]
+    # Distance d is first reached at radius ceil(d); the centre itself is visited at r = 1
+    found_radius = np.maximum(np.ceil(dist), 1)
+    return np.where(dist <= max_radius, found_radius, 0).astype(np.int64)
+
+def score_frame_points(points, gt_instance_mask, pred_point_ids, scale_x, scale_y, W_scaled, H_scaled, tracer=NO_TRACE):
+    """
+    Scores all the predicted points of a frame against the GT instance mask.
+
+    A point scores 1.0 if its GT ID matches the one assigned in the first frame, otherwise the score of the
+    radius at which the ID is found (SCORE_TABLE) or 0.0. Off-screen points are only scored if found
+    by the radius search and are ignored otherwise.
+
+    Args:
+        points (np.ndarray): (N, 3) predicted (x, y, confidence) in the scaled space.
+        gt_instance_mask (np.ndarray): (H, W) GT instance IDs.
+        pred_point_ids (np.ndarray): (N,) GT ID assigned to each point in the first frame.
+        tracer (Tracer, optional): Receives the per-reason event counts and the sampled per-point traces.
+
+    Returns:
+        tuple: (scores, counted, kept) where scores is (N,) float64, counted marks the points
+               counted in total_predicted_points and kept the points that contribute a score.
+    """
+    H_orig, W_orig = gt_instance_mask.shape[:2]
+    score_lut = np.array([0.0] + [SCORE_TABLE.get(r, 0.0) for r in range(1, MAX_SEARCH_RADIUS + 1)])
+
+    x_pred, y_pred = points[:, 0], points[:, 1]
+    off_screen = ~((x_pred >= 0) & (x_pred < W_scaled) & (y_pred >= 0) & (y_pred < H_scaled))
+    x_mapped, y_mapped = map_to_gt(points, scale_x, scale_y)
+    mapped_inside = (x_mapped >= 0) & (x_mapped < W_orig) & (y_mapped >= 0) & (y_mapped < H_orig)
+
+    # In-bounds points: consistent if foreground and ID match
+    gt_ids = lookup_gt_ids(gt_instance_mask, x_mapped, y_mapped)
+    consistent = ~off_screen & mapped_inside & (gt_ids == pred_point_ids) & (gt_ids != 0)
+    scores = np.where(consistent, 1.0, 0.0)
+
+    # Radius search for off-screen points and for in-bounds points that are not consistent
+    search = off_screen | (mapped_inside & ~consistent)
+    found_radius = np.zeros(len(points), dtype=np.int64)
+    found_radius[search] = radius_search(gt_instance_mask, x_mapped[search], y_mapped[search], pred_point_ids[search])
+    scores[search] = score_lut[found_radius[search]]
+
+    # Off-screen points not found are ignored; in-bounds points mapped outside the GT are counted but not scored
+    counted = ~(off_screen & (found_radius == 0))
+    kept = counted & (off_screen | mapped_inside)
+
+    if tracer.count_enabled:
+        found = found_radius > 0
+        tracer.count("off-screen, found by radius search", np.count_nonzero(off_screen & found))
+        tracer.count("off-screen, ignored", np.count_nonzero(off_screen & ~found))
+        tracer.count("mapped out of GT bounds", np.count_nonzero(~off_screen & ~mapped_inside))
+        tracer.count("consistent (ID match)", np.count_nonzero(consistent))
+        tracer.count("ID mismatch (foreground)", np.count_nonzero(~off_screen & mapped_inside & ~consistent & (gt_ids != 0)))
+        tracer.count("background", np.count_nonzero(~off_screen & mapped_inside & (gt_ids == 0)))
+        for r, n in enumerate(np.bincount(found_radius[search], minlength=MAX_SEARCH_RADIUS + 1)[1:], start=1):
+            tracer.count(f"radius hit at r={r}", n)
+    if tracer.trace_enabled:
+        for k in tracer.sample(len(points)):
+            tracer.trace("Point %d: pred=(%.2f, %.2f) off_screen=%s mapped=(%d, %d) GT ID=%d assigned ID=%d radius=%d score=%.2f",
+                         k, x_pred[k], y_pred[k], off_screen[k], x_mapped[k], y_mapped[k], gt_ids[k], pred_point_ids[k], found_radius[k], scores[k])
+    return scores, counted, kept
+
+def group_by_object(obj_ids, values):
+    """Yields (obj_id, values of that object) in order of first appearance of each object."""
+    order = np.argsort(obj_ids, kind="stable")
+    uniq, first, counts = np.unique(obj_ids[order], return_index=True, return_counts=True)
+    groups = np.split(values[order], np.cumsum(counts)[:-1])
+    for j in np.argsort(order[first]):
+        yield uniq[j], groups[j]
+
+def calculate_tracking_consistency(video_path, spatrack2_path, results_writer, tracer=NO_TRACE):
     """
     Calculates Tracking Consistency for a single video.
+
+    The per-frame, per-object scores are written to results_writer (results_store.ResultsWriter).
     """
     print(f"\n--- Evaluating Video: {os.path.basename(video_path)} ---")
 
@@ -22,30 +171,29 @@ def calculate_tracking_consistency(video_path, spatrack2_path):
     # Load SpatialTrackerV2 predictions
     pred_path = os.path.join(spatrack2_path, 'track2d_pred.npz')
     try:
-        stv2_results = np.load(pred_path)
-        # Assume the key is the first in the file
-        pred_tracks_2d = stv2_results[list(stv2_results.keys())[0]] # Shape (T_pred, N, 3)
-        print(f"DEBUG: Loaded predictions from {pred_path}, shape: {pred_tracks_2d.shape}")
+        # Memory-mapped, frames are read from disk as the loop reaches them
+        pred_tracks_2d = load_tracks(pred_path) # Shape (T_pred, N, 3)
+        tracer.debug("Loaded predictions from %s, shape: %s", pred_path, pred_tracks_2d.shape)
     except FileNotFoundError:
         print(f"ERROR: File 'track2d_pred.npz' not found. Skipping.")
         return None
 
-    # Find ground truth mask files
-    gt_mask_files = sorted(glob(os.path.join(video_path, 'gt_masks', 'segmentation_*.png')))
-    print(f"DEBUG: Found {len(gt_mask_files)} GT mask files in {os.path.join(video_path, 'gt_masks')}")
-    if not gt_mask_files:
+    # Load the ground truth masks (decoded once, then memory-mapped from the GT mask cache)
+    gt_labels, _ = load_gt_label_maps(os.path.join(video_path, 'gt_masks'))
+    tracer.debug("Found %d GT mask files in %s", len(gt_labels), os.path.join(video_path, 'gt_masks'))
+    if len(gt_labels) == 0:
         print("ERROR: No ground truth masks found. Skipping.")
         return None
 
     # --- 2. DETERMINE PARAMETERS ---
     
     num_pred_frames, num_points, _ = pred_tracks_2d.shape
-    num_gt_frames = len(gt_mask_files)
+    num_gt_frames = len(gt_labels)
     
     # Load the first mask to get original dimensions
-    first_gt_mask = np.array(Image.open(gt_mask_files[0]))
+    first_gt_mask = gt_labels[0]
     H_orig, W_orig = first_gt_mask.shape[:2] # Handles both (H,W) and (H,W,3)
-    print(f"DEBUG: First GT mask shape: {first_gt_mask.shape}")
+    tracer.debug("First GT mask shape: %s", first_gt_mask.shape)
 
     # Scaled dimensions used by STv2
     H_scaled, W_scaled = 336, 336
@@ -58,190 +206,206 @@ def calculate_tracking_consistency(video_path, spatrack2_path):
 
     print(f"Info: {num_gt_frames} GT frames, {num_pred_frames} predicted frames. Calculated stride: {stride}")
     print(f"Info: Original (GT) resolution: {W_orig}x{H_orig}, Predicted resolution: {W_scaled}x{H_scaled}")
-    print(f"DEBUG: scale_x={scale_x}, scale_y={scale_y}")
+    tracer.debug("scale_x=%s, scale_y=%s", scale_x, scale_y)
 
     # --- 3. INITIALIZE COUNTERS ---
     total_predicted_points = 0
     consistent_score = 0.0
 
     # --- NEW: Assign IDs to predicted points in first frame ---
-    pred_point_ids = np.zeros(num_points, dtype=int)
-    # Use the first GT mask for ID assignment
-    for k in range(num_points):
-        x_pred, y_pred, confidence = pred_tracks_2d[0, k, :]
-        # Rescale coordinates
-        x_mapped = int(x_pred * scale_x)
-        y_mapped = int(y_pred * scale_y)
-        # Check bounds
-        if 0 <= x_mapped < W_orig and 0 <= y_mapped < H_orig:
-            if first_gt_mask.ndim == 3:
-                # RGB mask: use first channel as ID (or custom logic)
-                pred_point_ids[k] = first_gt_mask[y_mapped, x_mapped, 0]
-            else:
-                pred_point_ids[k] = first_gt_mask[y_mapped, x_mapped]
-        else:
-            pred_point_ids[k] = 0  # background or out of bounds
+    # Use the first GT mask for ID assignment (background or out of bounds -> 0)
+    pred_point_ids = lookup_gt_ids(first_gt_mask, *map_to_gt(pred_tracks_2d[0], scale_x, scale_y))
 
-    # --- Prepare CSV output (one CSV per video) ---
-    # We write per-frame rows with columns [video_name, frame, object_id, iou].
+    # --- Results: per-frame rows with columns [video_name, frame, object_id, iou] ---
+    # NOTE: iou here is a point-based proxy per object
     video_name = os.path.basename(video_path)
-    csv_path = os.path.join(os.path.dirname(spatrack2_path), "tracking_consistency_spatrack2.csv")
-    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
 
     # --- 4. ITERATE AND CALCULATE CONSISTENCY ---
-    # Open CSV once for this video and append rows for each frame
-    with open(csv_path, mode="a", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-        # Header as requested
-        if csv_file.tell() == 0:
-            csv_writer.writerow(["video_name", "frame", "object_id", "iou"])  # iou here is a point-based proxy per object
-
-        for i in range(num_pred_frames):
-            # a. Find the corresponding GT frame
-            gt_frame_index = i * stride
-            print(f"DEBUG: Frame {i}: GT frame index {gt_frame_index}")
-            if gt_frame_index >= len(gt_mask_files):
-                print(f"Warning: GT index {gt_frame_index} out of bounds. Breaking loop.")
-                break
-            gt_mask_path = gt_mask_files[gt_frame_index]
-            gt_instance_mask = np.array(Image.open(gt_mask_path))
-            print(f"DEBUG: Loaded GT mask {gt_mask_path}, shape: {gt_instance_mask.shape}")
-
-            # b. Create "Foreground" mask (True if not background)
-            # Handles both ID masks and RGB masks
-            if gt_instance_mask.ndim == 3:
-                # RGB mask: foreground where any channel is non-zero
-                foreground_mask = np.any(gt_instance_mask != 0, axis=2)
-            else:
-                # Single-channel ID mask: foreground where id != 0
-                foreground_mask = gt_instance_mask != 0
-
-            # c. Iterate over points in this frame
-            # Collect per-object scores for this frame, then write CSV rows after processing all points of the frame
-            frame_obj_scores = defaultdict(list)
-
-            for k in range(num_points):
-                x_pred, y_pred, confidence = pred_tracks_2d[i, k, :]
-                print(f"DEBUG: Frame {i}, Point {k}: x_pred={x_pred}, y_pred={y_pred}, confidence={confidence}")
-
-                total_predicted_points += 1
-                found_score = 0.0
-
-                # i. Off-screen points in predicted (scaled) space
-                if not (0 <= x_pred < W_scaled and 0 <= y_pred < H_scaled):
-                    print(f"DEBUG: Point {k} is off-screen (predicted coords: {x_pred}, {y_pred}), trying radius search.")
-                    # Rescale coordinates for radius search
-                    x_mapped = int(x_pred * scale_x)
-                    y_mapped = int(y_pred * scale_y)
-                    # Radius search logic
-                    max_radius = 5
-                    score_table = {1: 0.99, 2: 0.9, 3: 0.8, 4: 0.5, 5: 0.30}  # tune these values
-                    target_id = pred_point_ids[k]
-                    found = False
-                    for r in range(1, max_radius + 1):
-                        for dx in range(-r, r + 1):
-                            for dy in range(-r, r + 1):
-                                if dx * dx + dy * dy > r * r:
-                                    continue
-                                nx = x_mapped + dx
-                                ny = y_mapped + dy
-                                if 0 <= nx < W_orig and 0 <= ny < H_orig:
-                                    if foreground_mask[ny, nx]:
-                                        if gt_instance_mask.ndim == 3:
-                                            local_id = gt_instance_mask[ny, nx, 0]
-                                        else:
-                                            local_id = gt_instance_mask[ny, nx]
-                                        if local_id == target_id and local_id != 0:
-                                            found_score = score_table.get(r, 0.0)
-                                            print(f"DEBUG: Off-screen Point {k} found in radius {r} at ({nx},{ny}), score={found_score}")
-                                            found = True
-                                            break
-                            if found:
-                                break
-                        if found:
-                            break
-                    if not found:
-                        # If still not found, ignore this point (decrement total_predicted_points) and skip CSV aggregation
-                        total_predicted_points -= 1
-                        print(f"DEBUG: Off-screen Point {k} not found in radius, ignored from total_predicted_points.")
-                        continue  # Skip rest of logic for off-screen points
-                    else:
-                        # Found via radius search, count towards global score and per-object aggregation
-                        consistent_score += found_score
-                        frame_obj_scores[pred_point_ids[k]].append(float(found_score))
-                        continue
-
-                # ii. In-bounds: rescale coordinates
-                x_mapped = int(x_pred * scale_x)
-                y_mapped = int(y_pred * scale_y)
-                print(f"DEBUG: Point {k} mapped to GT coords: ({x_mapped}, {y_mapped})")
-
-                # Ensure mapped coordinates are still within bounds after rounding
-                if not (0 <= x_mapped < W_orig and 0 <= y_mapped < H_orig):
-                    print(f"DEBUG: Mapped point {k} out of GT bounds, skipping.")
-                    continue
-
-                # iii. Check consistency: foreground and ID match
-                if foreground_mask[y_mapped, x_mapped]:
-                    # Get GT ID at this location
-                    if gt_instance_mask.ndim == 3:
-                        gt_id = gt_instance_mask[y_mapped, x_mapped, 0]
-                    else:
-                        gt_id = gt_instance_mask[y_mapped, x_mapped]
-                    if gt_id == pred_point_ids[k] and gt_id != 0:
-                        found_score = 1.0
-                        print(f"DEBUG: Point {k} is consistent (foreground, ID match: {gt_id}).")
-                    else:
-                        print(f"DEBUG: Point {k} is foreground but ID mismatch (GT: {gt_id}, Pred: {pred_point_ids[k]}).")
-                else:
-                    print(f"DEBUG: Point {k} is NOT consistent (background).")
-
-                # iv. If not found, search in a circle of radius 5 around mapped location
-                if found_score == 0.0:
-                    max_radius = 5
-                    score_table = {1: 0.99, 2: 0.9, 3: 0.8, 4: 0.5, 5: 0.30}  # tune these values
-                    target_id = pred_point_ids[k]
-                    found = False
-                    for r in range(1, max_radius + 1):
-                        for dx in range(-r, r + 1):
-                            for dy in range(-r, r + 1):
-                                if dx * dx + dy * dy > r * r:
-                                    continue
-                                nx = x_mapped + dx
-                                ny = y_mapped + dy
-                                if 0 <= nx < W_orig and 0 <= ny < H_orig:
-                                    if foreground_mask[ny, nx]:
-                                        if gt_instance_mask.ndim == 3:
-                                            local_id = gt_instance_mask[ny, nx, 0]
-                                        else:
-                                            local_id = gt_instance_mask[ny, nx]
-                                        if local_id == target_id and local_id != 0:
-                                            found_score = score_table.get(r, 0.0)
-                                            print(f"DEBUG: Point {k} found in radius {r} at ({nx},{ny}), score={found_score}")
-                                            found = True
-                                            break
-                        if found:
-                            break
-                    # no special handling if still 0.0: keep the point with score 0
-
-                # v. Accumulate scores
-                consistent_score += found_score
-                frame_obj_scores[pred_point_ids[k]].append(float(found_score))
-
-            # d. After processing all points of the frame, write one CSV row per object with the mean score
-            # NOTE: "iou" here represents the mean point-consistency score for that object in this frame.
-            for obj_id, scores in frame_obj_scores.items():
-                obj_iou = float(np.mean(scores)) if len(scores) > 0 else 0.0
-                csv_writer.writerow([video_name, gt_frame_index, int(obj_id), obj_iou])
+    # a. Corresponding GT frame of each predicted frame (i * stride); stop at the first one out of bounds
+    num_frames = min(num_pred_frames, -(-num_gt_frames // stride)) if stride > 0 else num_pred_frames
+
+    def load_frame(i):
+        return np.array(gt_labels[i * stride]), np.array(pred_tracks_2d[i])
+
+    # The next frames are read on background threads while the current one is scored
+    frames = prefetch(load_frame, range(num_frames), depth=PREFETCH_DEPTH, max_bytes=PREFETCH_MAX_MB << 20)
+    for i, (gt_instance_mask, frame_tracks) in frames:
+        gt_frame_index = i * stride
+        tracer.debug("Frame %d: GT frame index %d", i, gt_frame_index)
+        tracer.debug("Loaded GT mask %d, shape: %s", gt_frame_index, gt_instance_mask.shape)
 
+        # b. Score all the points of this frame at once
+        scores, counted, kept = score_frame_points(frame_tracks, gt_instance_mask, pred_point_ids, scale_x, scale_y, W_scaled, H_scaled, tracer)
+        total_predicted_points += int(np.count_nonzero(counted))
+        # Sequential sum over the points, same rounding as accumulating them one by one
+        consistent_score = float(np.cumsum(np.concatenate(([consistent_score], scores[kept])))[-1])
+
+        # c. Write one row per object with the mean score, objects in order of first appearance
+        # NOTE: "iou" here represents the mean point-consistency score for that object in this frame.
+        for obj_id, obj_scores in group_by_object(pred_point_ids[kept], scores[kept]):
+            obj_iou = float(np.mean(obj_scores)) if len(obj_scores) > 0 else 0.0
+            results_writer.writerow([video_name, gt_frame_index, int(obj_id), obj_iou])
+
+    if num_frames < num_pred_frames:
+        tracer.debug("Frame %d: GT frame index %d", num_frames, num_frames * stride)
+        print(f"Warning: GT index {num_frames * stride} out of bounds. Breaking loop.")
 
     # --- 5. CALCULATE FINAL RESULT ---
     
     tracking_consistency = (consistent_score / total_predicted_points) * 100 if total_predicted_points > 0 else 0
     print(f"Result: Consistency score {consistent_score:.2f} out of {total_predicted_points} total points.")
-    print(f"DEBUG: Tracking consistency = {tracking_consistency:.2f}%")
+    tracer.debug("Tracking consistency = %.2f%%", tracking_consistency)
     return tracking_consistency
 
+def object_centroids(tracks_3d, pred_point_ids, obj_ids):
+    """
+    Averages the predicted 3D tracks of each object, for all frames at once.
+
+    Args:
+        tracks_3d (np.ndarray): (T, N, 3) predicted 3D positions.
+        pred_point_ids (np.ndarray): (N,) GT ID assigned to each track.
+        obj_ids (np.ndarray): (K,) IDs of the objects.
+
+    Returns:
+        np.ndarray: (T, K, 3) mean position of the valid (finite) tracks of each object, NaN if there are none.
+    """
+    assignment = (pred_point_ids[None, :] == obj_ids[:, None]).astype(np.float64)  # (K, N)
+    valid = np.isfinite(tracks_3d).all(axis=-1)                                      # (T, N)
+    tracks = np.where(valid[..., None], tracks_3d, 0.0)
+    sums = np.einsum("kn,tn,tnd->tkd", assignment, valid.astype(np.float64), tracks)
+    counts = np.einsum("kn,tn->tk", assignment, valid.astype(np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums / counts[..., None]
+
+def median_scale(pred_disp, gt_disp):
+    """
+    Scale aligning predicted to GT displacements: median of ||gt|| / ||pred|| over the entries where both are
+    finite and the prediction moved (1.0 if there are none).
+
+    Args:
+        pred_disp (np.ndarray): (..., 3) predicted displacements.
+        gt_disp (np.ndarray): (..., 3) GT displacements, same shape.
+
+    Returns:
+        float: The scale to multiply the predicted displacements by.
+    """
+    pred_norm = np.linalg.norm(pred_disp, axis=-1)
+    gt_norm = np.linalg.norm(gt_disp, axis=-1)
+    valid = np.isfinite(pred_norm) & np.isfinite(gt_norm) & (pred_norm > 1e-9)
+    if not valid.any():
+        return 1.0
+    return float(np.median(gt_norm[valid] / pred_norm[valid]))
+
+def similarity_alignment(pred_disp, gt_disp):
+    """
+    Rotation and scale best mapping predicted to GT displacements, s * R @ pred ~ gt, in the least squares sense
+    (Umeyama, without translation: displacements from the first frame are already translation-free).
+    Only the entries where both displacements are finite are used.
+
+    Args:
+        pred_disp (np.ndarray): (..., 3) predicted displacements.
+        gt_disp (np.ndarray): (..., 3) GT displacements, same shape.
+
+    Returns:
+        tuple: (s, R) with s a float and R a (3, 3) rotation; (1.0, identity) if the prediction does not move.
+    """
+    valid = np.isfinite(pred_disp).all(axis=-1) & np.isfinite(gt_disp).all(axis=-1)
+    pred, gt = pred_disp[valid], gt_disp[valid]  # (M, 3)
+    pred_var = (pred ** 2).sum() / max(len(pred), 1)
+    if pred_var < 1e-12:
+        return 1.0, np.eye(3)
+    U, D, Vt = np.linalg.svd(gt.T @ pred / len(pred))
+    S = np.diag([1.0, 1.0, np.sign(np.linalg.det(U) * np.linalg.det(Vt)) or 1.0])  # proper rotation, no reflection
+    R = U @ S @ Vt
+    return float((D * np.diag(S)).sum() / pred_var), R
+
+def calculate_epe3d(video_path, spatrack2_path, results_writer, tracer=NO_TRACE):
+    """
+    Calculates the EPE-3D of every object of a single video.
+
+    Each track is assigned to the GT object under it in the first frame (as for Tracking Consistency) and
+    the tracks of an object are averaged into its predicted 3D position. Since the tracks lie on the object
+    surface while Kubric gives the object centre (metadata.json instances[id - 1]["positions"]), the
+    comparison is made on the displacement from the first frame:
+        EPE-3D(t) = || s * R @ (pred(t) - pred(0)) - (gt(t) - gt(0)) ||
+    The predictions (TRACKS_3D_KEY of TRACKS_3D_NAME) are in the frame of the estimated poses, at an unknown
+    scale: s and R are fitted once per video on all its displacements (see ALIGNMENT). The per-frame,
+    per-object errors are written to results_writer (results_store.ResultsWriter).
+    """
+    print(f"\n--- EPE-3D: {os.path.basename(video_path)} ---")
+
+    # --- 1. LOAD DATA ---
+    try:
+        first_tracks_2d = load_tracks(os.path.join(spatrack2_path, 'track2d_pred.npz'), frames=0)  # Shape (N, 3)
+        pred_tracks_3d = load_tracks(os.path.join(spatrack2_path, TRACKS_3D_NAME), key=TRACKS_3D_KEY)  # Shape (T_pred, N, 3), memory-mapped
+    except FileNotFoundError as e:
+        print(f"ERROR: {e.filename} not found. Skipping.")
+        return None
+    if first_tracks_2d.shape[0] != pred_tracks_3d.shape[1]:
+        print(f"ERROR: {first_tracks_2d.shape[0]} 2D tracks but {pred_tracks_3d.shape[1]} 3D tracks. Skipping.")
+        return None
+    with open(os.path.join(video_path, "metadata.json"), "r") as f:
+        metadata = json.load(f)
+    gt_positions = np.array([instance["positions"] for instance in metadata["instances"]], dtype=np.float64)  # (K, T_gt, 3)
+    gt_labels, _ = load_gt_label_maps(os.path.join(video_path, 'gt_masks'))
+    if len(gt_labels) == 0 or len(gt_positions) == 0:
+        print("ERROR: No ground truth masks or instances found. Skipping.")
+        return None
+
+    # --- 2. ALIGN FRAMES (same stride logic as Tracking Consistency) ---
+    num_pred_frames = pred_tracks_3d.shape[0]
+    num_gt_frames = len(gt_labels)
+    stride = round(num_gt_frames / num_pred_frames) if num_pred_frames > 0 else 1
+    pred_frames = np.arange(num_pred_frames)
+    gt_frames = pred_frames * stride
+    in_range = (gt_frames < num_gt_frames) & (gt_frames < gt_positions.shape[1])
+    pred_frames, gt_frames = pred_frames[in_range], gt_frames[in_range]
+    tracer.debug("EPE-3D: %d aligned frames, stride %d", len(pred_frames), stride)
+
+    # --- 3. ASSIGN TRACKS TO OBJECTS ---
+    H_orig, W_orig = gt_labels.shape[1:3]
+    scale_x, scale_y = W_orig / 336, H_orig / 336
+    pred_point_ids = lookup_gt_ids(gt_labels[0], *map_to_gt(first_tracks_2d, scale_x, scale_y))
+    obj_ids = np.unique(pred_point_ids[(pred_point_ids > 0) & (pred_point_ids <= len(gt_positions))])
+    if len(obj_ids) == 0 or len(pred_frames) == 0:
+        print("ERROR: No tracks on GT objects. Skipping.")
+        return None
+
+    # --- 4. EPE-3D FOR ALL FRAMES AND OBJECTS AT ONCE ---
+    pred_pos = object_centroids(pred_tracks_3d[pred_frames], pred_point_ids, obj_ids)  # (T, K, 3)
+    gt_pos = gt_positions[obj_ids - 1][:, gt_frames].transpose(1, 0, 2)                # (T, K, 3)
+    pred_disp, gt_disp = pred_pos - pred_pos[:1], gt_pos - gt_pos[:1]
+    if ALIGNMENT == "similarity":
+        scale, rotation = similarity_alignment(pred_disp[1:], gt_disp[1:])
+        tracer.debug("EPE-3D: predicted displacements rotated and rescaled by %.4f", scale)
+        pred_disp = scale * pred_disp @ rotation.T
+    elif ALIGNMENT == "scale":
+        scale = median_scale(pred_disp[1:], gt_disp[1:])
+        tracer.debug("EPE-3D: predicted displacements rescaled by %.4f", scale)
+        pred_disp = pred_disp * scale
+    elif ALIGNMENT is not None:
+        raise ValueError(f"Unknown EPE-3D alignment: {ALIGNMENT}")
+    epe = np.linalg.norm(pred_disp - gt_disp, axis=-1)                                    # (T, K)
+
+    # --- 5. WRITE RESULTS (same layout as the Tracking Consistency results) ---
+    video_name = os.path.basename(video_path)
+    valid = np.isfinite(epe)
+    frame_idx, obj_idx = np.nonzero(valid)
+    results_writer.write_columns(video_name, gt_frames[frame_idx], obj_ids[obj_idx], epe[valid])
+
+    mean_epe = float(epe[valid].mean()) if valid.any() else float("nan")
+    print(f"Result: EPE-3D {mean_epe:.4f} over {len(obj_ids)} objects and {len(pred_frames)} frames.")
+    return mean_epe
+
+def video_inputs(videos_path, spatrack2_output_path, video_name):
+    """Input files/directories of a video, recorded in the manifest to detect changes."""
+    return [
+        os.path.join(spatrack2_output_path, video_name, 'track2d_pred.npz'),
+        os.path.join(spatrack2_output_path, video_name, TRACKS_3D_NAME),
+        os.path.join(videos_path, video_name, 'gt_masks'),
+        os.path.join(videos_path, video_name, 'metadata.json'),
+    ]
+
 # --- MAIN SCRIPT ---
 
 if __name__ == "__main__":
@@ -249,17 +413,65 @@ if __name__ == "__main__":
     spatrack2_output_path = os.path.join(videos_path, "results", "SpaTrackV2")
     video_names = [os.path.basename(d) for d in sorted(glob(os.path.join(videos_path, "video_*")))]
     # video_names = ["video_24_more_dynamic_long"] # test su singolo video
+    TRACE_LEVEL = "info"            # "info" (full speed), "debug" (per-frame lines) or "trace" (also sampled per-point lines)
+    TRACE_SAMPLE_EVERY = 1000       # at "trace" level, trace 1 point every TRACE_SAMPLE_EVERY
+    COUNT_EVENTS = True             # print a summary of the per-reason events (off-screen, ID mismatch, radius hits)
+    tracer = Tracer(TRACE_LEVEL, sample_every=TRACE_SAMPLE_EVERY, count_events=COUNT_EVENTS)
+    EXPORT_CSV = True               # also export the results to tracking_consistency_spatrack2.csv / epe3d_spatrack2.csv
+    consistency_output_path = os.path.join(spatrack2_output_path, "tracking_consistency_spatrack2.parquet")
+    epe3d_output_path = os.path.join(spatrack2_output_path, "epe3d_spatrack2.parquet")
+    manifest_path = os.path.join(spatrack2_output_path, "benchmark_manifest.json")  # unchanged videos are not recomputed
+    os.makedirs(spatrack2_output_path, exist_ok=True)
+
+    # Find the videos whose inputs did not change since the last run and keep their previous rows
+    manifest = Manifest(manifest_path, METRIC_VERSION)
+    if not (os.path.exists(consistency_output_path) and os.path.exists(epe3d_output_path)):
+        manifest.prune([])
+    fingerprints = {video_name: manifest.fingerprint(video_name, video_inputs(videos_path, spatrack2_output_path, video_name)) for video_name in video_names}
+    unchanged = [video_name for video_name in video_names if manifest.is_current(video_name, fingerprints[video_name])]
+    if unchanged:
+        previous_consistency = read_results(consistency_output_path, videos=unchanged)
+        previous_epe3d = read_results(epe3d_output_path, videos=unchanged)
+    # The results are written to temporary files, renamed over the previous results only at the end:
+    # a crashed run leaves the previous results (and the manifest pointing at them) untouched
+    for stale_path in glob(consistency_output_path + ".*.tmp.parquet") + glob(epe3d_output_path + ".*.tmp.parquet"):
+        os.remove(stale_path)  # left by a crashed run
+    tmp_suffix = f".{os.getpid()}.tmp.parquet"
+    consistency_writer = ResultsWriter(consistency_output_path + tmp_suffix, "iou")
+    epe3d_writer = ResultsWriter(epe3d_output_path + tmp_suffix, "epe3d")
 
-    print(f"DEBUG: Found video names: {video_names}")
+    tracer.debug("Found video names: %s", video_names)
 
     results = {}
+    epe3d_results = {}
     for video_name in video_names:
         video_path = os.path.join(videos_path, video_name)
         spatrack2_path = os.path.join(spatrack2_output_path, video_name)
-        print(f"DEBUG: Processing video '{video_name}'")
-        consistency = calculate_tracking_consistency(video_path, spatrack2_path)
+        tracer.debug("Processing video '%s'", video_name)
+        if video_name in unchanged:
+            print(f"\n--- Video {video_name} unchanged, keeping previous results ---")
+            consistency_writer.write_dataframe(previous_consistency[previous_consistency["video_name"] == video_name])
+            epe3d_writer.write_dataframe(previous_epe3d[previous_epe3d["video_name"] == video_name])
+            summary = manifest.summary(video_name)
+            consistency, epe3d = summary["consistency"], summary["epe3d"]
+        else:
+            consistency = calculate_tracking_consistency(video_path, spatrack2_path, consistency_writer, tracer)
+            epe3d = calculate_epe3d(video_path, spatrack2_path, epe3d_writer, tracer)
+            manifest.update(video_name, fingerprints[video_name], {"consistency": consistency, "epe3d": epe3d})
         if consistency is not None:
             results[video_name] = consistency
+        if epe3d is not None:
+            epe3d_results[video_name] = epe3d
+
+    consistency_writer.close()
+    epe3d_writer.close()
+    os.replace(consistency_writer.path, consistency_output_path)
+    os.replace(epe3d_writer.path, epe3d_output_path)
+    if EXPORT_CSV:
+        export_csv(consistency_output_path)
+        export_csv(epe3d_output_path)
+    manifest.prune(video_names)
+    manifest.save()
             
     print("\n\n===== FINAL BENCHMARK RESULTS =====")
     if results:
@@ -268,4 +480,10 @@ if __name__ == "__main__":
         
         total_avg_consistency = sum(results.values()) / len(results)
         print(f"\nOverall Average Consistency: {total_avg_consistency:.2f}%")
-    print("===================================")
\ No newline at end of file
+    if epe3d_results:
+        print()
+        for video_name, epe3d in epe3d_results.items():
+            print(f"Video '{video_name}': EPE-3D = {epe3d:.4f}")
+        print(f"\nOverall Average EPE-3D: {sum(epe3d_results.values()) / len(epe3d_results):.4f}")
+    print("===================================")
+    tracer.summary()
\ No newline at end of file
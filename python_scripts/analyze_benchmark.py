@@ -1,13 +1,14 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import os
+from results_store import read_results
 
 # --- CONFIGURATION ---
 # CSV_FILE_PATH = '/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/examples/meeting_11_09/benchmark/tracking_consistency_spatrack2.csv'
 # OUTPUT_DIR = '/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/examples/meeting_11_09/benchmark/benchmark_plots_spatrack2' # Folder where plots will be saved
-CSV_FILE_PATH = '/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/examples/meeting_11_09/benchmark/iou_sam2.csv'
+CSV_FILE_PATH = '/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/examples/meeting_11_09/benchmark/iou_sam2.parquet' # .parquet (preferred) or .csv
 OUTPUT_DIR = '/Users/nicoloiacobone/Desktop/nico/UNIVERSITA/MAGISTRALE/Tesi/Tommasi/Zurigo/git_clones/examples/meeting_11_09/benchmark/benchmark_plots_sam2' # Folder where plots will be saved
+VIDEOS = None # list of video names to analyze (None = all); with Parquet only their rows are read
 
 # Create the output directory if it does not exist
 if not os.path.exists(OUTPUT_DIR):
@@ -17,11 +18,11 @@ if not os.path.exists(OUTPUT_DIR):
 
 print("--- 1. Loading data ---")
 try:
-    # Load the CSV. Pandas will automatically read the header from the first row.
-    df = pd.read_csv(CSV_FILE_PATH)
+    # Load only the columns used below (and only the selected videos)
+    expected_cols = ['video_name', 'frame', 'iou']
+    df = read_results(CSV_FILE_PATH, columns=expected_cols, videos=VIDEOS)
     
     # Safety check: verify that the expected columns are present
-    expected_cols = ['video_name', 'frame', 'object_id', 'iou']
     if not all(col in df.columns for col in expected_cols):
         print("WARNING: The columns in the CSV file do not match the expected ones.")
         print(f"Expected columns: {expected_cols}")
@@ -48,13 +49,13 @@ total_miou = df['iou'].mean()
 print(f"Total mIoU (on the whole dataset): {total_miou:.4f}\n")
 
 # mIoU for each video
-miou_per_video = df.groupby('video_name')['iou'].mean()
+miou_per_video = df.groupby('video_name', observed=True)['iou'].mean()
 print("--- mIoU per Video ---")
 print(miou_per_video.to_string())
 print("\n")
 
 # mIoU for each frame of each video (useful for detailed analysis)
-miou_per_frame = df.groupby(['video_name', 'frame'])['iou'].mean()
+miou_per_frame = df.groupby(['video_name', 'frame'], observed=True)['iou'].mean()
 print("--- mIoU per Frame (first 10 rows) ---")
 print(miou_per_frame.head(10).to_string())
 
@@ -120,7 +121,7 @@ for video_name in videos_to_plot:
 plt.figure(figsize=(12, 8))
 # boxplot = sns.boxplot(x='video_name', y='iou', data=df, palette="coolwarm")
 # Create a new column with shortened video names (e.g., "video_01")
-df['short_video_name'] = df['video_name'].apply(lambda x: '_'.join(x.split('_')[:2]))
+df['short_video_name'] = df['video_name'].astype(str).apply(lambda x: '_'.join(x.split('_')[:2]))
 boxplot = sns.boxplot(x='short_video_name', y='iou', hue='short_video_name', data=df, palette="coolwarm", legend=False)
 boxplot.set_title('Distribution of IoU Scores per Video', fontsize=16)
 # boxplot.set_title('Distribution of Tracking Consistency per Video', fontsize=16)
@@ -2,9 +2,12 @@
 import os
 import sys
 import pickle
+import cv2
+import imageio.v2 as imageio
 import numpy as np
 import matplotlib.pyplot as plt
 from PIL import Image
+from mask_store import open_video_segments
 
 # Imposta qui la directory contenente il file vide_segments.pkl
 
@@ -90,36 +93,123 @@ def main():
     print(shape)
     print(data[0])
 
+def list_frame_names(images_dir):
+    """Nomi dei frame JPEG/JPG nella directory, ordinati per numero di frame."""
+    frame_names = [
+        p for p in os.listdir(images_dir)
+        if os.path.splitext(p)[-1].lower() in [".jpg", ".jpeg"]
+    ]
+    frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+    return frame_names
+
 def visualize_sam_segments(masks_path, images_dir):
     """
     Visualizza le maschere SAM da un file numpy.
     
     Args:
-        masks_path: percorso al file video_segments.npy
+        masks_path: percorso al file video_segments.npy/.pkl (o al suo store compatto video_segments_packed.npy)
         images_dir: directory contenente i frame JPEG/JPG
     """
 
-    data = np.load(masks_path, allow_pickle=True)
-    data = data.item()
+    # Le maschere vengono lette frame per frame dallo store compatto (creato al primo utilizzo)
+    segments = open_video_segments(masks_path)
     
     # Scansiona tutti i frame JPEG nella directory
-    frame_names = [
-        p for p in os.listdir(images_dir)
-        if os.path.splitext(p)[-1].lower() in [".jpg", ".jpeg"]
-    ]
-    frame_names.sort(key=lambda p: int(os.path.splitext(p)[0]))
+    frame_names = list_frame_names(images_dir)
     
     for out_frame_idx in range(len(frame_names)):
         plt.figure(figsize=(6, 4))
         plt.title(f"frame {out_frame_idx}")
         plt.imshow(Image.open(os.path.join(images_dir, frame_names[out_frame_idx])))
-        for out_obj_id, out_mask in data[out_frame_idx].items():
+        for out_obj_id, out_mask in segments.frame_masks(out_frame_idx).items():
             show_mask(out_mask, plt.gca(), obj_id=out_obj_id)
     
     plt.show()
 
+def mask_color_lut(max_obj_id):
+    """
+    Tabella (max_obj_id + 1, 3) dei colori tab10 per obj_id, gli stessi di show_mask.
+    Calcolata una volta sola: matplotlib non viene usato frame per frame.
+    """
+    cmap = plt.get_cmap("tab10")
+    return cmap(np.arange(max_obj_id + 1))[:, :3].astype(np.float32) * 255
+
+def overlay_masks(image, frame_masks, lut, alpha=0.6):
+    """
+    Sovrappone tutte le maschere di un frame all'immagine con un'unica fusione alpha in NumPy.
+
+    Args:
+        image: (H, W, 3) uint8 RGB
+        frame_masks: dict obj_id -> (H, W) maschera booleana
+        lut: colori per obj_id (vedi mask_color_lut)
+        alpha: opacità delle maschere (0.6 come show_mask)
+
+    Returns:
+        (H, W, 3) uint8 RGB. Dove le maschere si sovrappongono prevale l'ultimo oggetto, come con imshow.
+    """
+    if not frame_masks:
+        return image
+    obj_ids = np.fromiter(frame_masks, dtype=np.intp, count=len(frame_masks))
+    masks = np.stack([np.asarray(m).reshape(image.shape[:2]) for m in frame_masks.values()])
+    # Indice dell'ultimo oggetto che copre ogni pixel (-1 = nessuno)
+    top = len(masks) - 1 - np.argmax(masks[::-1], axis=0)
+    covered = masks.any(axis=0)
+    out = image.copy()
+    colors = lut[obj_ids[top[covered]]]
+    out[covered] = (image[covered] * (1 - alpha) + colors * alpha + 0.5).astype(np.uint8)
+    return out
+
+def overlay_frames(segments, images_dir, alpha=0.6):
+    """Genera i frame RGB con le maschere sovrapposte, uno alla volta (memoria costante)."""
+    frame_names = list_frame_names(images_dir)
+    max_obj_id = max((max(obj_ids, default=0) for _, obj_ids in segments.index.values()), default=0)
+    lut = mask_color_lut(max_obj_id)
+    for out_frame_idx, name in enumerate(frame_names):
+        image = np.array(Image.open(os.path.join(images_dir, name)).convert("RGB"))
+        yield overlay_masks(image, segments.frame_masks(out_frame_idx), lut, alpha)
+
+def render_overlay_video(masks_path, images_dir, output_path, fps=24, alpha=0.6):
+    """
+    Scrive un video (.mp4) o una GIF con le maschere SAM sovrapposte ai frame, senza matplotlib.
+    I frame vengono generati e scritti uno alla volta: la memoria non cresce con la lunghezza del video.
+
+    Args:
+        masks_path: percorso al file video_segments.npy/.pkl (o al suo store compatto)
+        images_dir: directory contenente i frame JPEG/JPG
+        output_path: file di uscita, .mp4 oppure .gif
+        fps: frame al secondo
+        alpha: opacità delle maschere
+    """
+    segments = open_video_segments(masks_path)
+    frames = overlay_frames(segments, images_dir, alpha)
+    first = next(frames, None)
+    if first is None:
+        print(f"Errore: nessun frame JPEG trovato in {images_dir}", file=sys.stderr)
+        return
+
+    if os.path.splitext(output_path)[-1].lower() == ".gif":
+        # Il writer GIF-PIL di imageio scrive ogni frame nel file appena lo riceve
+        # (PIL con append_images, e il plugin GIF di default di imageio, tengono in memoria tutti i frame fino alla fine)
+        with imageio.get_writer(output_path, format="GIF-PIL", mode="I", duration=1 / fps, loop=0) as gif:
+            gif.append_data(first)
+            for frame in frames:
+                gif.append_data(frame)
+    else:
+        height, width = first.shape[:2]
+        video = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        video.write(first[..., ::-1])  # RGB -> BGR
+        for frame in frames:
+            video.write(frame[..., ::-1])
+        video.release()
+    print(f"Video salvato in {output_path}")
+
 if __name__ == "__main__":
     INPUT_DIR = "analyze_this"
+    RENDER_VIDEO = True     # True: scrive OUTPUT_VIDEO (veloce, memoria costante); False: una figura matplotlib per frame
+    OUTPUT_VIDEO = os.path.join(INPUT_DIR, "sam_overlay.mp4")   # .mp4 oppure .gif
     masks_path = os.path.join(INPUT_DIR, "video_segments.npy")
-    visualize_sam_segments(masks_path, INPUT_DIR)
+    if RENDER_VIDEO:
+        render_overlay_video(masks_path, INPUT_DIR, OUTPUT_VIDEO)
+    else:
+        visualize_sam_segments(masks_path, INPUT_DIR)
     # main()
\ No newline at end of file
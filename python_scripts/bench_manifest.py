@@ -0,0 +1,88 @@
+# Content manifest for incremental re-benchmarking
+# For every video the manifest records the size, mtime and SHA-1 of each input file (predictions and GT)
+# together with the metric version and the summary printed for that video. On the next run a video is
+# recomputed only if its inputs or the metric version changed; the others keep their previous rows.
+# Hashes are reused as long as size and mtime do not change, so an unchanged benchmark is only stat'ed.
+
+import os
+import json
+import hashlib
+
+def _sha1(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _list_files(input_paths):
+    """Yields (path, stat) of the given files and of the files directly inside the given directories."""
+    for path in input_paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    if entry.is_file():
+                        yield entry.path, entry.stat()
+        elif os.path.exists(path):
+            yield path, os.stat(path)
+
+class Manifest:
+    """
+    Per-video record of the benchmark inputs, stored as JSON.
+
+    Args:
+        path (str): JSON file of the manifest.
+        metric_version (int): Version of the metric code; a different version invalidates every video.
+    """
+
+    def __init__(self, path, metric_version):
+        self.path = path
+        self.metric_version = metric_version
+        self.videos = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("metric_version") == metric_version:
+                self.videos = data["videos"]
+
+    def fingerprint(self, video_name, input_paths):
+        """
+        Returns {path: [size, mtime_ns, sha1]} of the inputs of a video.
+
+        Files whose size and mtime match the manifest keep their recorded hash and are not read.
+        """
+        known = self.videos.get(video_name, {}).get("inputs", {})
+        fingerprint = {}
+        for path, stat in _list_files(input_paths):
+            previous = known.get(path)
+            if previous is not None and previous[:2] == [stat.st_size, stat.st_mtime_ns]:
+                fingerprint[path] = previous
+            else:
+                fingerprint[path] = [stat.st_size, stat.st_mtime_ns, _sha1(path)]
+        return fingerprint
+
+    def is_current(self, video_name, fingerprint):
+        """True if the video was computed with the same metric version from inputs with the same content."""
+        record = self.videos.get(video_name)
+        if record is None:
+            return False
+        hashes = {path: entry[2] for path, entry in record["inputs"].items()}
+        return hashes == {path: entry[2] for path, entry in fingerprint.items()}
+
+    def summary(self, video_name):
+        """Summary stored with the last computation of the video."""
+        return self.videos[video_name]["summary"]
+
+    def update(self, video_name, fingerprint, summary):
+        """Records a (re)computed video."""
+        self.videos[video_name] = {"inputs": fingerprint, "summary": summary}
+
+    def prune(self, video_names):
+        """Forgets the videos that are not in video_names anymore."""
+        self.videos = {name: record for name, record in self.videos.items() if name in video_names}
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"metric_version": self.metric_version, "videos": self.videos}, f)
+        os.replace(tmp_path, self.path)
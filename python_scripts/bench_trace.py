@@ -0,0 +1,63 @@
+# Leveled tracing for the benchmark scripts
+# - "info":  no debug output; the only cost left in the hot loops is checking a boolean attribute
+# - "debug": per-frame DEBUG lines and per-reason event counters
+# - "trace": also per-point lines, for a sample of 1 point every sample_every
+# Event counters (e.g. off-screen, ID mismatch, radius hit at r) can also be enabled on their own,
+# to get an aggregate diagnostic summary from a full-speed run.
+
+from collections import Counter
+import numpy as np
+
+LEVELS = {"info": 0, "debug": 1, "trace": 2}
+
+class Tracer:
+    """
+    Debug output and event counters of a benchmark run.
+
+    Args:
+        level (str): One of LEVELS.
+        sample_every (int): At "trace" level, trace 1 point every sample_every.
+        count_events (bool): Count events even below "debug" level.
+    """
+
+    def __init__(self, level="info", sample_every=1000, count_events=False):
+        self.level = LEVELS[level]
+        self.debug_enabled = self.level >= LEVELS["debug"]
+        self.trace_enabled = self.level >= LEVELS["trace"]
+        self.count_enabled = count_events or self.debug_enabled
+        self.sample_every = max(int(sample_every), 1)
+        self.counts = Counter()
+        self._seen = 0
+
+    def debug(self, msg, *args):
+        """Prints a DEBUG line, formatting msg % args only when enabled."""
+        if self.debug_enabled:
+            print("DEBUG: " + (msg % args if args else msg))
+
+    def trace(self, msg, *args):
+        """Prints a TRACE line (sampled per-point output), formatting msg % args only when enabled."""
+        if self.trace_enabled:
+            print("TRACE: " + (msg % args if args else msg))
+
+    def sample(self, n):
+        """
+        Returns the indices, within a batch of n items, of the items to trace.
+
+        Sampling is continuous across batches: 1 item every sample_every over the whole run.
+        """
+        first = (-self._seen) % self.sample_every
+        self._seen += n
+        return np.arange(first, n, self.sample_every)
+
+    def count(self, reason, n=1):
+        """Adds n events of the given reason."""
+        if self.count_enabled and n:
+            self.counts[reason] += int(n)
+
+    def summary(self):
+        """Prints the event counters."""
+        if not self.counts:
+            return
+        print("\n----- Trace summary (events) -----")
+        for reason, n in sorted(self.counts.items()):
+            print(f"{reason}: {n}")
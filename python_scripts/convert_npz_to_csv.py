@@ -7,23 +7,17 @@ import os
 import numpy as np
 import sys
 import csv
+from track_store import iter_frame_windows
 
 file_path = "/scratch2/nico/examples/kubric/results/SpaTrackV2/test_track_2d/video_02_static_medium/track2d_pred.npz"
 
-data = np.load(file_path)
-# print(list(data.keys()))
 csv_file_path = file_path.replace('.npz', '.csv')
 
-arr = data['track2d_pred']  # assuming the array is stored with this key
-n, m, _ = arr.shape
+WINDOW = 256  # frames read from the memory map (and converted) at a time
 
 with open(csv_file_path, 'w', newline='') as csvfile:
     writer = csv.writer(csvfile)
-    for i in range(n):
-        row = []
-        for j in range(m):
-            x, y = arr[i, j, 0], arr[i, j, 1]
-            x_scaled = int(round(x * 255 / 336))
-            y_scaled = int(round(y * 255 / 336))
-            row.extend([x_scaled, y_scaled])
-        writer.writerow(row)
\ No newline at end of file
+    for start, window in iter_frame_windows(file_path, WINDOW, key='track2d_pred'):
+        # (x, y) of all the objects of the window, scaled and rounded at once: one row of x0, y0, x1, y1, ... per frame
+        scaled = np.rint(np.asarray(window[..., :2]) * 255 / 336).astype(np.int64)
+        writer.writerows(scaled.reshape(len(scaled), -1).tolist())
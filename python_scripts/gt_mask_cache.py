@@ -0,0 +1,116 @@
+# Persistent cache of the decoded Kubric GT masks (gt_masks/segmentation_XXXXX.png)
+# All the frames of a video are decoded once into a single (T, H, W) uint8/uint16 array of instance IDs,
+# saved as an uncompressed .npy next to gt_masks/ and read back memory-mapped (zero-copy) by the benchmarks.
+# The cache is rebuilt automatically when the PNGs change (name, size or mtime) or when the decoding changes.
+# Palette ("P") / gray masks do not depend on the palette, so their cache is shared by all the benchmarks
+# (gt_masks_cache.npy); RGB masks are decoded with a palette and get one cache per palette
+# (gt_masks_cache.<palette hash>.npy), so that scripts using different palettes do not rebuild each other's cache.
+
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from PIL import Image
+from mask_reader import decode_instance_ids, ID_MODES
+
+CACHE_VERSION = 2
+CACHE_NAME = "gt_masks_cache"   # -> <video>/gt_masks_cache[.<palette hash>].npy + .json
+GT_MASK_PATTERN = re.compile(r"segmentation_(\d+)\.png$")
+
+def _decode_frame(path, palette):
+    """Returns the instance IDs of a GT mask and whether the palette was needed to decode it."""
+    with Image.open(path) as img:
+        return decode_instance_ids(img, palette), img.mode not in ID_MODES
+
+def _scan_gt_masks(gt_masks_dir):
+    """Returns the (frame number, name, size, mtime_ns) of every GT mask, sorted by name."""
+    files = []
+    with os.scandir(gt_masks_dir) as entries:
+        for entry in entries:
+            match = GT_MASK_PATTERN.match(entry.name)
+            if match:
+                stat = entry.stat()
+                files.append((int(match.group(1)), entry.name, stat.st_size, stat.st_mtime_ns))
+    files.sort(key=lambda f: f[1])
+    return files
+
+def _palette_key(palette):
+    if palette is None:
+        return "none"
+    return hashlib.sha1(np.asarray(palette, dtype=np.uint8).tobytes()).hexdigest()
+
+def _read_meta(prefix):
+    """Metadata of the cache prefix.npy/prefix.json, None if the cache is missing."""
+    if not (os.path.exists(prefix + ".npy") and os.path.exists(prefix + ".json")):
+        return None
+    with open(prefix + ".json", "r") as f:
+        return json.load(f)
+
+def build_gt_cache(gt_masks_dir, palette=None):
+    """
+    Makes sure the cache of a gt_masks/ directory is up to date, decoding the PNGs only if needed.
+
+    Args:
+        gt_masks_dir (str): Path to the gt_masks/ directory of a video.
+        palette (np.ndarray, optional): Palette used to decode RGB masks (see mask_reader.decode_instance_ids).
+
+    Returns:
+        tuple: (cache_path, frame_rows) where cache_path is the .npy with the (T, H, W) IDs
+               and frame_rows maps the frame number of each segmentation_XXXXX.png to its row.
+    """
+    gt_masks_dir = os.path.normpath(gt_masks_dir)
+    shared_prefix = os.path.join(os.path.dirname(gt_masks_dir), CACHE_NAME)
+    palette_key = _palette_key(palette)
+    palette_prefix = f"{shared_prefix}.{palette_key[:12]}"
+
+    files = _scan_gt_masks(gt_masks_dir)
+    meta = {
+        "version": CACHE_VERSION,
+        "files": [[name, size, mtime] for _, name, size, mtime in files],
+    }
+    frame_rows = {frame: row for row, (frame, _, _, _) in enumerate(files)}
+
+    # Valid cache: same source files and either decoded without palette (shared) or with this palette
+    for prefix, expected_palette in [(shared_prefix, None), (palette_prefix, palette_key)]:
+        cached = _read_meta(prefix)
+        if cached is not None and cached == dict(meta, palette=expected_palette):
+            return prefix + ".npy", frame_rows
+
+    decoded = [_decode_frame(os.path.join(gt_masks_dir, name), palette) for _, name, _, _ in files]
+    frames = [ids for ids, _ in decoded]
+    palette_used = any(used for _, used in decoded)
+    prefix = palette_prefix if palette_used else shared_prefix
+    meta["palette"] = palette_key if palette_used else None
+    cache_path, meta_path = prefix + ".npy", prefix + ".json"
+    print(f"Building GT mask cache {cache_path} ({len(files)} frames)")
+
+    max_id = max((int(frame.max()) for frame in frames), default=0)
+    if max_id >= 1 << 16:
+        raise ValueError(f"Instance ID {max_id} in {gt_masks_dir} does not fit in the uint16 cache")
+    dtype = np.uint8 if max_id < 256 else np.uint16
+    shape = (len(frames),) + (frames[0].shape if frames else (0, 0))
+
+    # Write to temporary files and rename, so that concurrent readers never see a partial cache
+    tmp_cache_path = f"{prefix}.{os.getpid()}.tmp.npy"
+    labels = np.lib.format.open_memmap(tmp_cache_path, mode="w+", dtype=dtype, shape=shape)
+    for row, frame in enumerate(frames):
+        labels[row] = frame
+    labels.flush()
+    del labels
+    os.replace(tmp_cache_path, cache_path)
+    tmp_meta_path = f"{prefix}.{os.getpid()}.tmp.json"
+    with open(tmp_meta_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_meta_path, meta_path)
+    return cache_path, frame_rows
+
+def load_gt_label_maps(gt_masks_dir, palette=None):
+    """
+    Returns the GT instance IDs of a video as a read-only memory-mapped (T, H, W) array.
+
+    Returns:
+        tuple: (labels, frame_rows), see build_gt_cache.
+    """
+    cache_path, frame_rows = build_gt_cache(gt_masks_dir, palette)
+    return np.load(cache_path, mmap_mode="r"), frame_rows
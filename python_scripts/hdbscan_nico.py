@@ -1,9 +1,21 @@
 import os
 import torch
+import torch.nn.functional as F
 import cv2
 import numpy as np
 import hdbscan
+import joblib
+import time
+import glob
+import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
 from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.random_projection import GaussianRandomProjection
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.feature_extraction.image import grid_to_graph
+from scipy import sparse
 from PIL import Image
 import matplotlib.pyplot as plt
 
@@ -14,16 +26,46 @@ import matplotlib.pyplot as plt
 # EMBEDDINGS_PATH = "/scratch2/nico/distillation/hdbscan_test/dino_features/dino_features.pt"
 EMBEDDINGS_PATH = "/scratch2/nico/distillation/hdbscan_test/concatenated_features/concatenated_embeddings.pt"
 # EMBEDDINGS_PATH = "/scratch2/nico/distillation/dataset/coco2017/features/val2017/000000003553.pt"
-# ENCODER_FEATURES = "/scratch2/nico/distillation/hdbscan_test/dino_features/dino_features.pt"
-# DECODER_FEATURES = "/scratch2/nico/distillation/hdbscan_test/transformer_features/transformer_features.pt"
 # EMBEDDINGS_PATH = "/scratch2/nico/distillation/output/distillation_3/visualizations/student/24.pt"   # percorso del file
+# Fusione delle feature in memoria (al posto di EMBEDDINGS_PATH): encoder e decoder concatenati sui canali
+FUSE_FEATURES = False                         # True: clusterizza la concatenazione di ENCODER_FEATURES e DECODER_FEATURES
+ENCODER_FEATURES = "/scratch2/nico/distillation/hdbscan_test/dino_features/dino_features.pt"
+DECODER_FEATURES = "/scratch2/nico/distillation/hdbscan_test/transformer_features/transformer_features.pt"
+FUSE_NORMALIZE = None                         # normalizzazione di ogni blocco: None, "l2" (per token), "block_std" (varianza totale 1)
+FUSE_WEIGHTS = (1.0, 1.0)                     # peso di encoder e decoder dopo la normalizzazione
+SAVE_FUSED = False                            # salva anche la fusione accanto a ENCODER_FEATURES (vedi fused_features_path)
 MIN_SAMPLES = 20                              # parametro HDBSCAN
 MIN_CLUSTER_SIZE = 50                         # parametro HDBSCAN
 NORMALIZE = True                              # normalizzazione opzionale
+REDUCER = None                                # riduzione dimensionale prima di HDBSCAN: None, "pca", "randomized_svd", "random_projection"
+REDUCED_DIM = 32                              # dimensioni dopo la riduzione (<= 60: HDBSCAN "best" usa boruvka_kdtree)
+CACHE_REDUCER = True                          # salva il riduttore accanto al file delle feature e lo riusa (mai in MODE "batch")
+HDBSCAN_ALGORITHM = "best"                    # algoritmo HDBSCAN ("best", "boruvka_kdtree", "prims_kdtree", ...)
+CLUSTER_ENGINE = "hdbscan"                    # "hdbscan" oppure "agglomerative" (vincolato alla griglia dei pixel: segmenti connessi)
+AGGLO_N_CLUSTERS = 20                         # numero di segmenti di "agglomerative" (None: usa AGGLO_DISTANCE_THRESHOLD)
+AGGLO_DISTANCE_THRESHOLD = None               # soglia di fusione di "agglomerative" (solo se AGGLO_N_CLUSTERS è None)
+AGGLO_NEIGHBOURS = 4                          # adiacenza della griglia: 4 o 8 vicini
+AGGLO_LINKAGE = "ward"                        # "ward", "average", "complete" o "single"
 PLOT = True                                   # mostrare il risultato
 # REFERENCE_IMG_PATH = "/scratch2/nico/distillation/dataset/coco2017/images/val2017/000000003661.jpg"
 REFERENCE_IMG_PATH = "/scratch2/nico/distillation/dataset/coco2017/images/val2017/000000003553.jpg"
 OUTPUT_PNG_PATH = os.path.dirname(EMBEDDINGS_PATH)
+# Modalità "fit_predict": un solo modello HDBSCAN, addestrato su token campionati da più file, etichetta tutti i file
+MODE = "single"                               # "single": fit su EMBEDDINGS_PATH; "fit_predict": fit una volta e predict su FEATURES_DIR; "batch": vedi sotto
+                                              # ("fit_predict" e BATCH_USE_MODEL richiedono CLUSTER_ENGINE = "hdbscan")
+FEATURES_DIR = "/scratch2/nico/distillation/dataset/coco2017/features/val2017"
+MODEL_PATH = os.path.join(FEATURES_DIR, "hdbscan_model.joblib")   # riusato se addestrato con le stesse impostazioni, altrimenti riaddestrato
+FIT_NUM_FILES = 20                            # file (equidistanti) da cui campionare i token per il fit
+FIT_SAMPLE_TOKENS = 2000                      # token campionati per file
+LABELS_OUTPUT_DIR = os.path.join(FEATURES_DIR, "hdbscan_labels")  # <stem>_labels.npy per ogni file
+# Modalità "batch": tutti i file di FEATURES_DIR in processi paralleli, ognuno con l'immagine con lo stesso nome in IMAGES_DIR
+IMAGES_DIR = "/scratch2/nico/distillation/dataset/coco2017/images/val2017"
+BATCH_OUTPUT_DIR = os.path.join(FEATURES_DIR, "hdbscan_batch")  # <stem>_labels.npy, <stem>_overlay.png, summary.csv
+BATCH_USE_MODEL = False                       # True: etichetta con il modello di "fit_predict" (MODEL_PATH) invece di un fit per file
+THREADS_PER_WORKER = 1                        # thread BLAS/OpenMP/torch per processo (evita oversubscription)
+# CPU assegnate al job (os.cpu_count() conta tutti i core del nodo, anche sotto Slurm)
+ALLOCATED_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+NUM_WORKERS = max(ALLOCATED_CPUS // THREADS_PER_WORKER, 1)   # processi paralleli
 # ===========================================
 
 def load_embeddings(path):
@@ -53,76 +95,68 @@ def load_embeddings(path):
         raise ValueError(f"Unsupported .pt content type: {type(obj)}")
     raise ValueError(f"Unsupported file extension: {ext}")
 
-def concatenate_embeddings(encoder_path, decoder_path):
-    feat1 = torch.load(encoder_path)   # es: [1, 1024, 24, 37]
-    feat2 = torch.load(decoder_path)   # es: [1, 768, 24, 37]
-
-    # --------------------------------------------------------
-    # 2. FLATTEN 2D → TOKEN FORMAT
-    #    [B, C, H, W] → [B, T, C]
-    # --------------------------------------------------------
-
-    def flatten_features(f):
-        B, C, H, W = f.shape
-        tokens = f.flatten(2)          # [B, C, H*W]
-        tokens = tokens.permute(0, 2, 1)  # [B, T, C]
-        return tokens, H, W
-
-    tokens1, H, W = flatten_features(feat1)
-    tokens2, _, _ = flatten_features(feat2)
-
-    # --------------------------------------------------------
-    # 3. CONCAT FEATURES
-    #    [B, T, C1] + [B, T, C2] → [B, T, C_total]
-    # --------------------------------------------------------
-
-    tokens_cat = torch.cat([tokens1, tokens2], dim=-1)
-
-    # --------------------------------------------------------
-    # 4. RESTORE SPATIAL MAP
-    #    [B, T, C_total] → [B, C_total, H, W]
-    # --------------------------------------------------------
-
-    def tokens_to_spatial(tokens, H, W):
-        B, T, C = tokens.shape
-        assert T == H * W, f"Token count mismatch: T={T}, H*W={H*W}"
-        x = tokens.reshape(B, H, W, C)     # [B, H, W, C]
-        x = x.permute(0, 3, 1, 2)          # [B, C, H, W]
-        return x
-
-    feat2d_cat = tokens_to_spatial(tokens_cat, H, W)
-
-    # --------------------------------------------------------
-    # OUTPUT
-    # --------------------------------------------------------
-
-    print("Encoder shape:", feat1.shape)
-    print("Decoder shape:", feat2.shape)
-    print("Flattened & concatenated tokens:", tokens_cat.shape)
-    print("Reconstructed 2D feature map:", feat2d_cat.shape)
-
-    # Ensure we save a torch.Tensor (not numpy)
-    if isinstance(feat2d_cat, np.ndarray):
-        feat2d_cat = torch.from_numpy(feat2d_cat)
-    save_path = os.path.join(os.path.dirname(encoder_path), "concatenated_embeddings.pt")
-    torch.save(feat2d_cat, save_path)
-    print(f"Saved concatenated embeddings to {save_path}")
-
-    # Example:
-    # Encoder shape: [1, 1024, 24, 37]
-    # Decoder shape: [1, 768, 24, 37]
-    # Flattened & concatenated tokens: [1, 888, 1792]
-    # Reconstructed 2D feature map: [1, 1792, 24, 37]
-    raise Exception
-    return feat2d_cat  # remove batch dim
-
-def main():
-    # concatenate_embeddings(ENCODER_FEATURES, DECODER_FEATURES)
-    # ---------------------------------------------------------
-    # 1. Load embeddings
-    # expected shape: (H, W, D) or (D, H, W) or possibly with a leading batch dim
-    # ---------------------------------------------------------
-    emb = load_embeddings(EMBEDDINGS_PATH)
+def make_reducer(method, dim):
+    """Unfitted dimensionality reducer: "pca", "randomized_svd" or "random_projection"."""
+    if method == "pca":
+        return PCA(n_components=dim, svd_solver="randomized", random_state=0)
+    if method == "randomized_svd":
+        return TruncatedSVD(n_components=dim, algorithm="randomized", random_state=0)
+    if method == "random_projection":
+        return GaussianRandomProjection(n_components=dim, random_state=0)
+    raise ValueError(f"Unknown reducer: {method}")
+
+def reducer_cache_path(features_path, method, dim, normalize):
+    """Reducer cache next to the features file, e.g. concatenated_embeddings.pca32_norm.reducer.joblib."""
+    stem = os.path.splitext(features_path)[0]
+    return f"{stem}.{method}{dim}{'_norm' if normalize else ''}.reducer.joblib"
+
+def reduce_features(flat, features_path, method, dim, normalize, use_cache=True):
+    """
+    Projects the (N, D) token features to (N, dim) before clustering.
+
+    HDBSCAN core distances and the minimum spanning tree degrade in high dimension; at <= 60 dimensions
+    the tree-based boruvka algorithm becomes effective. The fitted reducer is cached per features file
+    and reused as long as the file is not modified.
+
+    Args:
+        flat (np.ndarray): (N, D) token features (already normalized if normalize).
+        features_path (str): Features file the tokens come from (cache key; None: no cache).
+        method (str): See make_reducer.
+        dim (int): Target dimension; no reduction if dim >= D.
+        normalize (bool): Whether flat was standardized (part of the cache key).
+        use_cache (bool): Load/save the fitted reducer.
+
+    Returns:
+        np.ndarray: (N, dim) reduced features.
+    """
+    if dim >= flat.shape[1]:
+        return flat
+    use_cache = use_cache and features_path is not None
+    cache_path = reducer_cache_path(features_path, method, dim, normalize) if use_cache else None
+    reducer = None
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(features_path):
+        reducer = joblib.load(cache_path)
+        if reducer.n_features_in_ != flat.shape[1]:
+            reducer = None
+        else:
+            print(f"Loaded cached reducer {cache_path}")
+    if reducer is None:
+        start = time.perf_counter()
+        reducer = make_reducer(method, dim).fit(flat)
+        print(f"Fitted {method} reducer {flat.shape[1]} -> {dim} dims in {time.perf_counter() - start:.2f}s")
+        if use_cache:
+            joblib.dump(reducer, cache_path)
+    return reducer.transform(flat).astype(np.float32)
+
+def load_embedding_map(path):
+    """Loads a feature file as an (H, W, D) map (see to_embedding_map)."""
+    return to_embedding_map(load_embeddings(path))
+
+def to_embedding_map(emb):
+    """
+    Converts an embeddings array to an (H, W, D) map.
+    Accepts (1, D, H, W), (H, W, D, 1), (D, H, W) and (H, W, D).
+    """
 
     # Accept common shapes and convert to (H, W, D)
     # - (1, D, H, W) or (N, D, H, W) with N==1 → squeeze batch
@@ -148,12 +182,172 @@ def main():
         print("Transposing embeddings from (D, H, W) to (H, W, D)")
         emb = emb.transpose(1, 2, 0)
 
+    return emb
+
+def list_feature_files(features_dir):
+    """Sorted .pt/.pth/.npy feature files of a directory."""
+    return sorted(p for p in glob.glob(os.path.join(features_dir, "*"))
+                  if os.path.splitext(p)[1].lower() in [".pt", ".pth", ".npy"])
+
+def fit_pooled_model(feature_paths, sample_tokens, normalize, reducer_method, reduced_dim, seed=0):
+    """
+    Fits scaler, reducer and HDBSCAN (with prediction data) once, on tokens sampled from several files.
+
+    Args:
+        feature_paths (list): Feature files to sample from.
+        sample_tokens (int): Tokens sampled (without replacement) from each file.
+        normalize (bool): Fit a StandardScaler.
+        reducer_method (str): See make_reducer (None: no reduction).
+        reduced_dim (int): Dimension after the reduction.
+        seed (int): Sampling seed.
+
+    Returns:
+        dict: "scaler", "reducer" (None if unused), "clusterer" and "fit_files".
+    """
+    rng = np.random.default_rng(seed)
+    samples = []
+    for path in feature_paths:
+        emb = load_embedding_map(path)
+        flat = emb.reshape(-1, emb.shape[-1])
+        idx = rng.choice(len(flat), size=min(sample_tokens, len(flat)), replace=False)
+        samples.append(flat[idx])
+    pooled = np.concatenate(samples).astype(np.float32)
+    print(f"Fitting on {len(pooled)} tokens pooled from {len(feature_paths)} files")
+
+    scaler = StandardScaler().fit(pooled) if normalize else None
+    if scaler is not None:
+        pooled = scaler.transform(pooled)
+    reducer = None
+    if reducer_method is not None and reduced_dim < pooled.shape[1]:
+        reducer = make_reducer(reducer_method, reduced_dim).fit(pooled)
+        pooled = reducer.transform(pooled).astype(np.float32)
+
+    start = time.perf_counter()
+    clusterer = hdbscan.HDBSCAN(
+        min_samples=MIN_SAMPLES,
+        min_cluster_size=MIN_CLUSTER_SIZE,
+        cluster_selection_method="leaf",
+        algorithm=HDBSCAN_ALGORITHM,
+        prediction_data=True
+    ).fit(pooled)
+    print(f"HDBSCAN fit done in {time.perf_counter() - start:.2f}s, clusters: {clusterer.labels_.max() + 1}")
+    return {"scaler": scaler, "reducer": reducer, "clusterer": clusterer, "fit_files": list(feature_paths)}
+
+def predict_labels(model, emb):
+    """
+    Labels the tokens of an (H, W, D) map with a model of fit_pooled_model (hdbscan.approximate_predict).
+    The same clusters get the same label in every file.
+
+    Returns:
+        np.ndarray: (H, W) labels (-1 = noise).
+    """
     H, W, D = emb.shape
-    print(f"Loaded embeddings: {emb.shape}")
-
+    flat = emb.reshape(-1, D).astype(np.float32)
+    if model["scaler"] is not None:
+        flat = model["scaler"].transform(flat)
+    if model["reducer"] is not None:
+        flat = model["reducer"].transform(flat).astype(np.float32)
+    labels, _ = hdbscan.approximate_predict(model["clusterer"], flat)
+    return labels.reshape(H, W)
+
+def model_settings():
+    """Configuration a pooled model is fitted with (stored in the model to detect stale models)."""
+    return {
+        "normalize": NORMALIZE,
+        "reducer": REDUCER,
+        "reduced_dim": REDUCED_DIM,
+        "min_samples": MIN_SAMPLES,
+        "min_cluster_size": MIN_CLUSTER_SIZE,
+        "algorithm": HDBSCAN_ALGORITHM,
+        "fit_num_files": FIT_NUM_FILES,
+        "fit_sample_tokens": FIT_SAMPLE_TOKENS,
+    }
+
+def load_or_fit_model(feature_paths):
+    """
+    Loads the model saved in MODEL_PATH if it was fitted with the current settings (see model_settings),
+    otherwise fits it on FIT_NUM_FILES files of feature_paths and saves it.
+    """
+    if CLUSTER_ENGINE != "hdbscan":
+        raise ValueError(f'A pooled model can only be fitted with CLUSTER_ENGINE = "hdbscan", got "{CLUSTER_ENGINE}"')
+    settings = model_settings()
+    if os.path.exists(MODEL_PATH):
+        model = joblib.load(MODEL_PATH)
+        if model.get("settings") == settings:
+            print(f"Loaded HDBSCAN model {MODEL_PATH} (fitted on {len(model['fit_files'])} files)")
+            return model
+        print(f"HDBSCAN model {MODEL_PATH} was fitted with other settings, refitting")
+    # Files evenly spaced over the directory (e.g. over the frames of a video)
+    fit_idx = np.unique(np.linspace(0, len(feature_paths) - 1, min(FIT_NUM_FILES, len(feature_paths))).round().astype(int))
+    model = fit_pooled_model([feature_paths[i] for i in fit_idx], FIT_SAMPLE_TOKENS, NORMALIZE, REDUCER, REDUCED_DIM)
+    model["settings"] = settings
+    joblib.dump(model, MODEL_PATH)
+    print(f"Saved HDBSCAN model to {MODEL_PATH}")
+    return model
+
+def fit_predict_directory():
+    """MODE "fit_predict": fits (or reloads) one model for FEATURES_DIR and saves the label map of every file."""
+    feature_paths = list_feature_files(FEATURES_DIR)
+    if not feature_paths:
+        raise FileNotFoundError(f"No feature files in {FEATURES_DIR}")
+
+    model = load_or_fit_model(feature_paths)
+
+    os.makedirs(LABELS_OUTPUT_DIR, exist_ok=True)
+    start = time.perf_counter()
+    for path in feature_paths:
+        seg = predict_labels(model, load_embedding_map(path))
+        stem = os.path.splitext(os.path.basename(path))[0]
+        np.save(os.path.join(LABELS_OUTPUT_DIR, f"{stem}_labels.npy"), seg)
+        print(f"{stem}: {seg.shape[0]}x{seg.shape[1]}, clusters: {len(np.unique(seg[seg >= 0]))}, noise: {np.mean(seg < 0):.1%}")
+    print(f"Labeled {len(feature_paths)} files in {time.perf_counter() - start:.2f}s, saved to {LABELS_OUTPUT_DIR}")
+
+def grid_connectivity(H, W, neighbours=4):
+    """Sparse (H*W, H*W) adjacency of the pixel grid with 4 or 8 neighbours."""
+    connectivity = grid_to_graph(H, W)
+    if neighbours == 8:
+        idx = np.arange(H * W).reshape(H, W)
+        diagonals = [(idx[:-1, :-1], idx[1:, 1:]), (idx[:-1, 1:], idx[1:, :-1])]
+        rows = np.concatenate([a.ravel() for a, b in diagonals] + [b.ravel() for a, b in diagonals])
+        cols = np.concatenate([b.ravel() for a, b in diagonals] + [a.ravel() for a, b in diagonals])
+        connectivity = connectivity + sparse.coo_matrix((np.ones(len(rows), dtype=connectivity.dtype), (rows, cols)), shape=(H * W, H * W))
+    elif neighbours != 4:
+        raise ValueError(f"neighbours must be 4 or 8, got {neighbours}")
+    return connectivity.tocsr()
+
+def agglomerative_grid_labels(flat, H, W):
+    """
+    Connectivity-constrained agglomerative clustering: only pixels adjacent in the grid can be merged,
+    so segments are spatially connected and the cost grows with the number of grid edges (~H*W),
+    not with all the pixel pairs.
+
+    Returns:
+        np.ndarray: (H*W,) labels (no noise label).
+    """
+    clusterer = AgglomerativeClustering(
+        n_clusters=AGGLO_N_CLUSTERS,
+        distance_threshold=AGGLO_DISTANCE_THRESHOLD if AGGLO_N_CLUSTERS is None else None,
+        linkage=AGGLO_LINKAGE,
+        connectivity=grid_connectivity(H, W, AGGLO_NEIGHBOURS)
+    )
+    return clusterer.fit_predict(flat)
+
+def cluster_embedding_map(emb, features_path, core_dist_n_jobs=4):
+    """
+    Clusters the pixels of an (H, W, D) embedding map (steps 2-4 of main).
+
+    Args:
+        emb (np.ndarray): (H, W, D) embeddings.
+        features_path (str): File the embeddings come from (key of the reducer cache; None: no cache).
+        core_dist_n_jobs (int): Parallel jobs of the HDBSCAN core distance computation.
+
+    Returns:
+        np.ndarray: (H, W) labels (-1 = noise).
+    """
     # ---------------------------------------------------------
     # 2. Flatten pixel embeddings → (H*W, D)
     # ---------------------------------------------------------
+    H, W, D = emb.shape
     flat = emb.reshape(-1, D)
 
     # ---------------------------------------------------------
@@ -164,18 +358,259 @@ def main():
         flat = StandardScaler().fit_transform(flat)
 
     # ---------------------------------------------------------
-    # 4. HDBSCAN clustering
+    # 3b. Optional: dimensionality reduction (PCA / randomized SVD / random projection)
     # ---------------------------------------------------------
+    if REDUCER is not None:
+        flat = reduce_features(flat, features_path, REDUCER, REDUCED_DIM, NORMALIZE, use_cache=CACHE_REDUCER)
+        print(f"Reduced embeddings: {flat.shape}")
+
+    # ---------------------------------------------------------
+    # 4. Clustering: HDBSCAN or grid-constrained agglomerative
+    # ---------------------------------------------------------
+    if CLUSTER_ENGINE == "agglomerative":
+        print(f"Running agglomerative clustering on the {AGGLO_NEIGHBOURS}-neighbour pixel grid...")
+        start = time.perf_counter()
+        labels = agglomerative_grid_labels(flat, H, W)
+        print(f"Agglomerative clustering done in {time.perf_counter() - start:.2f}s")
+        print(f"Clusters found: {len(np.unique(labels))}")
+        return labels.reshape(H, W)
+
     print("Running HDBSCAN clustering...")
+    start = time.perf_counter()
     clusterer = hdbscan.HDBSCAN(
         min_samples=MIN_SAMPLES,
         min_cluster_size=MIN_CLUSTER_SIZE,
-        cluster_selection_method="leaf"
+        cluster_selection_method="leaf",
+        algorithm=HDBSCAN_ALGORITHM,
+        core_dist_n_jobs=core_dist_n_jobs
     ).fit(flat)
+    print(f"HDBSCAN done in {time.perf_counter() - start:.2f}s")
 
     labels = clusterer.labels_
     print(f"Clusters found: {len(np.unique(labels))} (label -1 = noise)")
 
+    return labels.reshape(H, W)
+
+def resize_segmentation(seg, ref_H, ref_W):
+    """Resizes an (H, W) label map to (ref_H, ref_W) with nearest-neighbour interpolation."""
+    H, W = seg.shape
+    if (H, W) == (ref_H, ref_W):
+        return seg
+    print(f"Resizing segmentation from ({H}, {W}) to ({ref_H}, {ref_W})")
+    return cv2.resize(seg.astype(np.float32), (ref_W, ref_H), interpolation=cv2.INTER_NEAREST).astype(int)
+
+TAB20_LUT = (np.array(plt.get_cmap("tab20").colors) * 255).astype(np.uint8)
+
+def pair_images(feature_paths, images_dir):
+    """Maps every features file to the image with the same stem in images_dir (None if there is none)."""
+    images = {}
+    if os.path.isdir(images_dir):
+        for name in os.listdir(images_dir):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in [".jpg", ".jpeg", ".png"]:
+                images[stem] = os.path.join(images_dir, name)
+    return {path: images.get(os.path.splitext(os.path.basename(path))[0]) for path in feature_paths}
+
+def overlay_segmentation(image, seg, alpha=0.5):
+    """Blends the cluster colours (tab20, label % 20) on an RGB image; noise (-1) is left uncoloured."""
+    out = image.astype(np.float32)
+    clustered = seg >= 0
+    out[clustered] = out[clustered] * (1 - alpha) + TAB20_LUT[seg[clustered] % 20] * alpha
+    return out.round().astype(np.uint8)
+
+_worker_models = {}
+
+def init_worker(num_threads):
+    """Limits the threads of the numerical libraries of a worker process (no BLAS/OpenMP oversubscription)."""
+    threadpool_limits(num_threads)
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+
+def segment_file(features_path, image_path, output_dir, model_path=None, num_threads=1):
+    """
+    Segments one features file and writes <stem>_labels.npy (feature resolution) and, if the image
+    is available, <stem>_overlay.png (image resolution). Runs in a worker process of run_batch.
+
+    Args:
+        features_path (str): Features file.
+        image_path (str): Image paired with the features (None: no overlay).
+        output_dir (str): Output directory.
+        model_path (str, optional): Model of fit_pooled_model to predict with, instead of fitting HDBSCAN on the file.
+        num_threads (int): Threads of the HDBSCAN core distance computation.
+
+    Returns:
+        dict: Summary row (cluster count, noise fraction, timings).
+    """
+    start = time.perf_counter()
+    emb = load_embedding_map(features_path)
+    loaded = time.perf_counter()
+    if model_path is not None:
+        if model_path not in _worker_models:
+            _worker_models[model_path] = joblib.load(model_path)
+        seg = predict_labels(_worker_models[model_path], emb)
+    else:
+        # No reducer cache: it would leave a .joblib next to every file of FEATURES_DIR
+        seg = cluster_embedding_map(emb, None, core_dist_n_jobs=num_threads)
+    clustered = time.perf_counter()
+
+    stem = os.path.splitext(os.path.basename(features_path))[0]
+    np.save(os.path.join(output_dir, f"{stem}_labels.npy"), seg.astype(np.int32))
+    if image_path is not None:
+        image = np.array(Image.open(image_path).convert("RGB"))
+        overlay = overlay_segmentation(image, resize_segmentation(seg, *image.shape[:2]))
+        Image.fromarray(overlay).save(os.path.join(output_dir, f"{stem}_overlay.png"))
+
+    return {
+        "file": stem,
+        "height": seg.shape[0],
+        "width": seg.shape[1],
+        "clusters": len(np.unique(seg[seg >= 0])),
+        "noise_fraction": float(np.mean(seg < 0)),
+        "image": image_path is not None,
+        "load_s": round(loaded - start, 3),
+        "cluster_s": round(clustered - loaded, 3),
+        "total_s": round(time.perf_counter() - start, 3),
+    }
+
+def run_batch():
+    """MODE "batch": segments every file of FEATURES_DIR in NUM_WORKERS processes and writes summary.csv."""
+    feature_paths = list_feature_files(FEATURES_DIR)
+    if not feature_paths:
+        raise FileNotFoundError(f"No feature files in {FEATURES_DIR}")
+    images = pair_images(feature_paths, IMAGES_DIR)
+    missing = sum(image is None for image in images.values())
+    print(f"Found {len(feature_paths)} feature files ({missing} without image in {IMAGES_DIR})")
+    os.makedirs(BATCH_OUTPUT_DIR, exist_ok=True)
+
+    model_path = None
+    if BATCH_USE_MODEL:
+        load_or_fit_model(feature_paths)
+        model_path = MODEL_PATH
+
+    rows = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=init_worker, initargs=(THREADS_PER_WORKER,)) as executor:
+        futures = {executor.submit(segment_file, path, images[path], BATCH_OUTPUT_DIR, model_path, THREADS_PER_WORKER): path
+                   for path in feature_paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                row = future.result()
+            except Exception as e:
+                print(f"Error on {futures[future]}: {e}")
+                continue
+            rows.append(row)
+            print(f"[{done}/{len(futures)}] {row['file']}: {row['clusters']} clusters in {row['total_s']:.2f}s")
+
+    rows.sort(key=lambda row: row["file"])
+    summary_path = os.path.join(BATCH_OUTPUT_DIR, "summary.csv")
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else ["file"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Segmented {len(rows)}/{len(feature_paths)} files in {time.perf_counter() - start:.2f}s, summary saved to {summary_path}")
+
+def normalize_block(feat, method):
+    """
+    Normalizes a [B, C, H, W] feature block before fusion.
+
+    - "l2": every token (pixel) vector has unit L2 norm over the channels of the block
+    - "block_std": channels are centered and the block is scaled to unit total variance,
+      so that blocks with different channel counts contribute equally to the distances
+    """
+    if method is None:
+        return feat
+    if method == "l2":
+        return F.normalize(feat, dim=1)
+    if method == "block_std":
+        centered = feat - feat.mean(dim=(2, 3), keepdim=True)
+        total_var = centered.pow(2).mean(dim=(2, 3)).sum(dim=1).view(-1, 1, 1, 1)
+        return centered / total_var.sqrt().clamp_min(1e-8)
+    raise ValueError(f"Unknown block normalization: {method}")
+
+def fuse_features(encoder_feats, decoder_feats, normalize=None, weights=(1.0, 1.0)):
+    """
+    Concatenates encoder and decoder feature maps along the channel dimension.
+
+    Args:
+        encoder_feats (torch.Tensor): [B, C1, H, W] (e.g. [1, 1024, 24, 37]).
+        decoder_feats (torch.Tensor): [B, C2, H, W] (e.g. [1, 768, 24, 37]).
+        normalize (str, optional): Per-block normalization, see normalize_block.
+        weights (tuple): Weight of each block after the normalization.
+
+    Returns:
+        torch.Tensor: [B, C1 + C2, H, W] (e.g. [1, 1792, 24, 37]).
+    """
+    if encoder_feats.shape[0] != decoder_feats.shape[0] or encoder_feats.shape[2:] != decoder_feats.shape[2:]:
+        raise ValueError(f"Spatial size mismatch: encoder {tuple(encoder_feats.shape)}, decoder {tuple(decoder_feats.shape)}")
+    blocks = []
+    for feat, weight in zip((encoder_feats, decoder_feats), weights):
+        feat = normalize_block(feat.float(), normalize)
+        blocks.append(feat * weight if weight != 1.0 else feat)
+    return torch.cat(blocks, dim=1)
+
+def fused_features_path(encoder_path, normalize=None, weights=(1.0, 1.0)):
+    """
+    File of a fusion next to the encoder features: concatenated_embeddings.pt for the plain concatenation,
+    e.g. concatenated_embeddings_l2_w1-0.5.pt otherwise, so that different fusions never overwrite each other.
+    """
+    suffix = "" if normalize is None else f"_{normalize}"
+    if tuple(weights) != (1.0, 1.0):
+        suffix += "_w" + "-".join(f"{w:g}" for w in weights)
+    return os.path.join(os.path.dirname(encoder_path), f"concatenated_embeddings{suffix}.pt")
+
+def concatenate_embeddings(encoder_path, decoder_path, normalize=None, weights=(1.0, 1.0), save=False):
+    """
+    Loads encoder and decoder features and fuses them in memory (see fuse_features).
+
+    Args:
+        encoder_path (str): Encoder features (.pt, [B, C1, H, W]).
+        decoder_path (str): Decoder features (.pt, [B, C2, H, W]).
+        normalize (str, optional): Per-block normalization, see normalize_block.
+        weights (tuple): Weight of each block.
+        save (bool): Also save the fusion next to the encoder features (see fused_features_path). A file newer
+            than both inputs is not rewritten, so that the reducer cache keyed on it stays valid.
+
+    Returns:
+        tuple: (fused [B, C1 + C2, H, W] tensor, path of the saved file or None).
+    """
+    feat1 = torch.load(encoder_path, map_location="cpu")   # es: [1, 1024, 24, 37]
+    feat2 = torch.load(decoder_path, map_location="cpu")   # es: [1, 768, 24, 37]
+    feat2d_cat = fuse_features(feat1, feat2, normalize, weights)
+
+    print("Encoder shape:", feat1.shape)
+    print("Decoder shape:", feat2.shape)
+    print("Fused 2D feature map:", feat2d_cat.shape)
+
+    save_path = None
+    if save:
+        save_path = fused_features_path(encoder_path, normalize, weights)
+        inputs_mtime = max(os.path.getmtime(encoder_path), os.path.getmtime(decoder_path))
+        if os.path.exists(save_path) and os.path.getmtime(save_path) >= inputs_mtime:
+            print(f"Concatenated embeddings {save_path} up to date")
+        else:
+            torch.save(feat2d_cat, save_path)
+            print(f"Saved concatenated embeddings to {save_path}")
+    return feat2d_cat, save_path
+
+def main():
+    # ---------------------------------------------------------
+    # 1. Load embeddings (or fuse encoder and decoder features in memory)
+    # expected shape: (H, W, D) or (D, H, W) or possibly with a leading batch dim
+    # ---------------------------------------------------------
+    if FUSE_FEATURES:
+        fused, features_path = concatenate_embeddings(ENCODER_FEATURES, DECODER_FEATURES, FUSE_NORMALIZE, FUSE_WEIGHTS, save=SAVE_FUSED)
+        emb = to_embedding_map(fused.numpy())
+    else:
+        features_path = EMBEDDINGS_PATH
+        emb = load_embedding_map(EMBEDDINGS_PATH)
+    H, W, D = emb.shape
+    print(f"Loaded embeddings: {emb.shape}")
+
+    # ---------------------------------------------------------
+    # 2-4. Normalize, reduce and cluster the pixel embeddings
+    # ---------------------------------------------------------
+    seg = cluster_embedding_map(emb, features_path)
+
     # ---------------------------------------------------------
     # 5. Reshape to (H, W) and resize to reference image if needed
     # ---------------------------------------------------------
@@ -184,16 +619,8 @@ def main():
     ref_img_np = np.array(ref_img)
     ref_H, ref_W = ref_img_np.shape[:2]
 
-    # Reshape clusters to match embedding shape
-    seg = labels.reshape(H, W)
-
     # If embedding shape differs from reference image, resize segmentation
-    if (H, W) != (ref_H, ref_W):
-        print(f"Resizing segmentation from ({H}, {W}) to ({ref_H}, {ref_W})")
-        seg_resized = cv2.resize(seg.astype(np.float32), (ref_W, ref_H), interpolation=cv2.INTER_NEAREST)
-        seg_resized = seg_resized.astype(int)
-    else:
-        seg_resized = seg
+    seg_resized = resize_segmentation(seg, ref_H, ref_W)
 
     # ---------------------------------------------------------
     # 6. Plot segmentation and reference image side by side
@@ -229,4 +656,9 @@ def main():
         plt.show()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if MODE == "fit_predict":
+        fit_predict_directory()
+    elif MODE == "batch":
+        run_batch()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,47 @@
+# Fast reader for the Kubric GT masks shared by the benchmark scripts
+# Kubric saves segmentation_XXXXX.png as palette ("P") images whose indices already are the instance IDs,
+# so they are read directly without expanding them to RGB. RGB masks are mapped back to IDs with a
+# 24-bit packed-RGB -> ID lookup table, built only once per palette and only when an RGB mask shows up.
+# The decoded frames are persisted by gt_mask_cache, so every mask is decoded only once.
+
+from functools import lru_cache
+import numpy as np
+
+# Image modes whose pixel values already are the instance IDs (the palette is not used)
+ID_MODES = ("P", "L", "I", "I;16")
+
+def pack_rgb(rgb):
+    """Packs an (..., 3) uint8 RGB array into (...) uint32 24-bit colour codes."""
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+@lru_cache(maxsize=8)
+def _rgb_lut(palette_bytes):
+    """Builds the (2**24,) packed-RGB -> ID table of a palette (colour at index i -> ID i, unknown colours -> 0)."""
+    palette = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(-1, 3)
+    dtype = np.uint8 if len(palette) <= 256 else np.uint16
+    lut = np.zeros(1 << 24, dtype=dtype)
+    # Reversed so that, as in a first-match search, a duplicated colour keeps its lowest index
+    for obj_id in range(len(palette) - 1, 0, -1):
+        lut[pack_rgb(palette[obj_id])] = obj_id
+    return lut
+
+def decode_instance_ids(img, palette=None):
+    """
+    Decodes an already opened GT mask into a (H, W) map of instance IDs.
+
+    Args:
+        img (PIL.Image.Image): The GT mask.
+        palette (np.ndarray, optional): (N, 3) uint8 colours of the IDs, e.g. hls_palette(n_objects + 1).
+            Only used for RGB masks: without it the first channel is taken as ID.
+
+    Returns:
+        np.ndarray: (H, W) array of instance IDs.
+    """
+    if img.mode in ID_MODES:
+        # Palette indices / gray levels are the IDs: no RGB expansion
+        return np.array(img)
+    rgb = np.array(img.convert("RGB"))
+    if palette is None:
+        return rgb[..., 0]
+    return _rgb_lut(np.ascontiguousarray(palette, dtype=np.uint8).tobytes())[pack_rgb(rgb)]
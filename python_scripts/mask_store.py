@@ -0,0 +1,147 @@
+# Compact bit-packed store for the SAM2 video_segments masks
+# video_segments.pkl/.npy hold one dense (1, H, W) bool array (one byte per pixel) per object and frame, and must
+# be unpickled entirely before any frame can be read. The packed store keeps every mask as a np.packbits row
+# (one bit per pixel, 8x smaller) of a single uncompressed (M, ceil(H*W/8)) uint8 .npy, read memory-mapped,
+# plus a JSON index frame -> (first row, object IDs): any frame or mask is read in O(1) without the others.
+# The store is written next to the segments file and rebuilt automatically when the segments file changes.
+
+import os
+import json
+import pickle
+import numpy as np
+
+STORE_VERSION = 1
+STORE_NAME = "video_segments_packed"   # -> video_segments_packed.npy + video_segments_packed.json
+
+def load_video_segments(segments_path):
+    """
+    Loads a video_segments file (.npy or .pkl) saved by SAM2.
+
+    Args:
+        segments_path (str): Path to video_segments.npy or video_segments.pkl.
+
+    Returns:
+        dict: frame index -> {object ID -> (1, H, W) or (H, W) mask}.
+    """
+    if segments_path.endswith(".npy"):
+        segments = np.load(segments_path, allow_pickle=True).item()
+    else:
+        with open(segments_path, "rb") as f:
+            segments = pickle.load(f)
+    return {int(frame_idx): {int(obj_id): mask for obj_id, mask in frame_masks.items()}
+            for frame_idx, frame_masks in segments.items()}
+
+def is_packed_store(path):
+    return os.path.splitext(os.path.basename(path))[0] == STORE_NAME
+
+def pack_video_segments(segments_path):
+    """
+    Converts a video_segments file into the packed store next to it (only if missing or outdated).
+
+    Args:
+        segments_path (str): Path to video_segments.npy or video_segments.pkl.
+
+    Returns:
+        str: Path to the packed .npy (its index is the .json with the same name).
+    """
+    prefix = os.path.join(os.path.dirname(segments_path), STORE_NAME)
+    store_path, meta_path = prefix + ".npy", prefix + ".json"
+    stat = os.stat(segments_path)
+    source = [os.path.basename(segments_path), stat.st_size, stat.st_mtime_ns]
+
+    # Valid store: same version and same source file
+    if os.path.exists(store_path) and os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta["version"] == STORE_VERSION and meta["source"] == source:
+            return store_path
+
+    segments = load_video_segments(segments_path)
+    frames = sorted(segments)
+    num_rows = sum(len(segments[frame_idx]) for frame_idx in frames)
+    first_mask = next((mask for frame_idx in frames for mask in segments[frame_idx].values()), None)
+    height, width = np.shape(first_mask)[-2:] if first_mask is not None else (0, 0)
+    print(f"Packing {segments_path} ({len(frames)} frames, {num_rows} masks of {height}x{width})")
+
+    # Write to temporary files and rename, so that concurrent readers never see a partial store
+    tmp_store_path = f"{prefix}.{os.getpid()}.tmp.npy"
+    rows = np.lib.format.open_memmap(tmp_store_path, mode="w+", dtype=np.uint8,
+                                     shape=(num_rows, (height * width + 7) // 8))
+    index = {}
+    row = 0
+    for frame_idx in frames:
+        obj_ids = sorted(segments[frame_idx])
+        index[str(frame_idx)] = [row, obj_ids]
+        for obj_id in obj_ids:
+            mask = np.asarray(segments[frame_idx][obj_id])
+            if mask.shape[-2:] != (height, width):
+                raise ValueError(f"Mask of frame {frame_idx}, object {obj_id} has shape {mask.shape}, expected (1, {height}, {width})")
+            rows[row] = np.packbits(mask.reshape(-1) > 0)
+            row += 1
+    rows.flush()
+    del rows
+    os.replace(tmp_store_path, store_path)
+    tmp_meta_path = f"{prefix}.{os.getpid()}.tmp.json"
+    with open(tmp_meta_path, "w") as f:
+        json.dump({"version": STORE_VERSION, "source": source, "shape": [height, width], "frames": index}, f)
+    os.replace(tmp_meta_path, meta_path)
+    return store_path
+
+class PackedMasks:
+    """
+    Read access to a packed store: masks are unpacked on demand from the memory-mapped rows.
+
+    Args:
+        store_path (str): Path to the packed .npy (see pack_video_segments).
+    """
+
+    def __init__(self, store_path):
+        self.path = store_path
+        self.rows = np.load(store_path, mmap_mode="r")
+        with open(os.path.splitext(store_path)[0] + ".json", "r") as f:
+            meta = json.load(f)
+        self.shape = tuple(meta["shape"])
+        self.index = {int(frame_idx): (first_row, obj_ids) for frame_idx, (first_row, obj_ids) in meta["frames"].items()}
+
+    def __len__(self):
+        return len(self.index)
+
+    def frames(self):
+        """Frame indices with predictions, sorted."""
+        return sorted(self.index)
+
+    def rows_of(self, frame_idx):
+        """{object ID -> row} of a frame (empty if the frame has no prediction)."""
+        first_row, obj_ids = self.index.get(frame_idx, (0, []))
+        return {obj_id: first_row + k for k, obj_id in enumerate(obj_ids)}
+
+    def _unpack(self, packed):
+        height, width = self.shape
+        return np.unpackbits(packed, axis=-1, count=height * width).view(bool).reshape(packed.shape[:-1] + (height, width))
+
+    def mask(self, row):
+        """(H, W) bool mask stored in a row."""
+        return self._unpack(np.asarray(self.rows[row]))
+
+    def frame_masks(self, frame_idx):
+        """{object ID -> (H, W) bool mask} of a frame, unpacked in one call (its rows are contiguous)."""
+        first_row, obj_ids = self.index.get(frame_idx, (0, []))
+        masks = self._unpack(np.asarray(self.rows[first_row:first_row + len(obj_ids)]))
+        return dict(zip(obj_ids, masks))
+
+def open_video_segments(path):
+    """Opens a video_segments .npy/.pkl (packing it on first use) or directly a packed store."""
+    return PackedMasks(path if is_packed_store(path) else pack_video_segments(path))
+
+# --- MAIN SCRIPT ---
+
+if __name__ == "__main__":
+    # Packs the video_segments of every video in advance and reports the size reduction
+    from glob import glob
+    SEGMENTS_GLOB = "/scratch2/nico/examples/kubric/results/sam2/*/video_segments.*"
+
+    for segments_path in sorted(glob(SEGMENTS_GLOB)):
+        store_path = pack_video_segments(segments_path)
+        source_size, store_size = os.path.getsize(segments_path), os.path.getsize(store_path)
+        print(f"{segments_path}: {source_size / 2**20:.1f} MB -> {store_size / 2**20:.1f} MB "
+              f"({source_size / max(store_size, 1):.1f}x)")
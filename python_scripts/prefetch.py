@@ -0,0 +1,59 @@
+# Bounded decode-ahead prefetch for the per-frame benchmark loops
+# While the current frame is scored, the next frames are loaded (PNG decode, memory-map reads) on a thread pool.
+# PIL and NumPy release the GIL while decoding/copying, so I/O and compute overlap even within a single video.
+# The pipeline is bounded both in number of frames (depth) and in memory (max_bytes).
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+_END = object()
+
+def nbytes(obj):
+    """Approximate memory of a loaded item (arrays, possibly nested in dicts/lists/tuples)."""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+def prefetch(loader, keys, depth=4, max_bytes=None, num_threads=None):
+    """
+    Yields (key, loader(key)) for every key, in order, loading up to depth keys ahead on a thread pool.
+
+    Args:
+        loader (callable): Loads the data of a key (e.g. a frame index).
+        keys (iterable): Keys to load, in order.
+        depth (int): Maximum number of keys loaded ahead. 0 loads synchronously.
+        max_bytes (int, optional): Memory cap of the loaded-ahead items. The size of the last loaded item
+            is used as estimate for the ones still in flight; at least one key is always loaded ahead.
+        num_threads (int, optional): Loader threads (default: depth).
+
+    Yields:
+        tuple: (key, loaded data).
+    """
+    keys = iter(keys)
+    if depth <= 0:
+        for key in keys:
+            yield key, loader(key)
+        return
+
+    pending = deque()
+    item_bytes = 0
+    with ThreadPoolExecutor(max_workers=num_threads or depth) as executor:
+        def fill():
+            while len(pending) < depth and (not pending or max_bytes is None or (len(pending) + 1) * item_bytes <= max_bytes):
+                key = next(keys, _END)
+                if key is _END:
+                    return
+                pending.append((key, executor.submit(loader, key)))
+
+        fill()
+        while pending:
+            key, future = pending.popleft()
+            data = future.result()
+            item_bytes = max(item_bytes, nbytes(data))
+            fill()
+            yield key, data
@@ -0,0 +1,125 @@
+# Columnar storage (Parquet) for the per-object benchmark results
+# Every benchmark produces rows [video_name, frame, object_id, <metric>]. They are written in batched row groups
+# with typed columns and a dictionary-encoded video_name, so that analyze_benchmark.py can read back only
+# the columns and the videos it needs instead of re-parsing a whole CSV. CSV export stays available.
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROW_GROUP_SIZE = 65536  # rows buffered before writing a row group
+
+def results_schema(value_column):
+    """Schema of a results table: dictionary-encoded video_name, int32 frame/object_id, float64 metric."""
+    return pa.schema([
+        ("video_name", pa.dictionary(pa.int32(), pa.string())),
+        ("frame", pa.int32()),
+        ("object_id", pa.int32()),
+        (value_column, pa.float64()),
+    ])
+
+class ResultsWriter:
+    """
+    Streams benchmark rows to a Parquet file in row groups of row_group_size rows.
+
+    Rows can be added one at a time with writerow (same interface as csv.writer) or as columns
+    with write_columns. Use as a context manager or call close() to flush the last row group.
+
+    Args:
+        path (str): Output .parquet file.
+        value_column (str): Name of the metric column (e.g. "iou").
+        row_group_size (int): Rows per row group.
+    """
+
+    def __init__(self, path, value_column, row_group_size=ROW_GROUP_SIZE):
+        self.path = path
+        self.value_column = value_column
+        self.schema = results_schema(value_column)
+        self.row_group_size = row_group_size
+        self._columns = {name: [] for name in self.schema.names}
+        self._buffered = 0
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def writerow(self, row):
+        """Adds a single [video_name, frame, object_id, value] row."""
+        for name, value in zip(self.schema.names, row):
+            self._columns[name].append([value])
+        self._buffered += 1
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def write_columns(self, video_name, frames, object_ids, values):
+        """Adds len(frames) rows of the same video from column arrays."""
+        frames = np.asarray(frames)
+        self._columns["video_name"].append([video_name] * len(frames))
+        self._columns["frame"].append(frames)
+        self._columns["object_id"].append(np.asarray(object_ids))
+        self._columns[self.value_column].append(np.asarray(values))
+        self._buffered += len(frames)
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def write_dataframe(self, df):
+        """Adds the rows of a results DataFrame (e.g. previous results returned by read_results)."""
+        for video_name, rows in df.groupby("video_name", observed=True, sort=False):
+            self.write_columns(str(video_name), rows["frame"], rows["object_id"], rows[self.value_column])
+
+    def flush(self):
+        """Writes the buffered rows as a row group."""
+        if self._buffered == 0:
+            return
+        arrays = [pa.array(np.concatenate(self._columns[field.name]) if field.name != "video_name"
+                           else [v for chunk in self._columns[field.name] for v in chunk]).cast(field.type)
+                  for field in self.schema]
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._columns = {name: [] for name in self.schema.names}
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def merge_results(shard_paths, output_path, sort_keys=("video_name", "frame", "object_id")):
+    """Merges Parquet shards into a single file sorted by sort_keys."""
+    table = pa.concat_tables([pq.read_table(path) for path in shard_paths])
+    # Sort on plain strings (dictionary order depends on the shard), then re-encode video_name
+    table = table.set_column(0, "video_name", table.column("video_name").cast(pa.string()))
+    table = table.sort_by([(key, "ascending") for key in sort_keys])
+    table = table.set_column(0, "video_name", table.column("video_name").dictionary_encode())
+    pq.write_table(table, output_path, row_group_size=ROW_GROUP_SIZE)
+
+def read_results(path, columns=None, videos=None):
+    """
+    Reads a results table (.parquet or .csv) into a DataFrame.
+
+    Args:
+        path (str): Results file.
+        columns (list, optional): Columns to read (Parquet reads only these columns from disk).
+        videos (list, optional): Videos to keep (Parquet skips the row groups of the other videos).
+
+    Returns:
+        pd.DataFrame: The results.
+    """
+    if os.path.splitext(path)[1] == ".csv":
+        df = pd.read_csv(path, usecols=columns)
+        return df[df["video_name"].isin(videos)] if videos is not None else df
+    filters = [("video_name", "in", list(videos))] if videos is not None else None
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+    if "video_name" in df.columns and isinstance(df["video_name"].dtype, pd.CategoricalDtype):
+        df["video_name"] = df["video_name"].cat.remove_unused_categories()
+    return df
+
+def export_csv(parquet_path, csv_path=None):
+    """Exports a Parquet results file to CSV (same name with .csv by default). Returns the CSV path."""
+    if csv_path is None:
+        csv_path = os.path.splitext(parquet_path)[0] + ".csv"
+    pd.read_parquet(parquet_path).to_csv(csv_path, index=False)
+    return csv_path
@@ -0,0 +1,64 @@
+# Memory-mappable storage for the SpatialTrackerV2 track predictions (track2d_pred.npz, result.npz)
+# A compressed .npz has to be decompressed entirely at every np.load. The first time a prediction is read,
+# its array is converted into an uncompressed .npy next to the .npz (e.g. track2d_pred.npy), which is then
+# memory-mapped: only the frames/points actually sliced are read from disk. An array explicitly selected
+# from a multi-array .npz (e.g. "coords" of result.npz) gets its own .npy (result.coords.npy).
+
+import os
+import numpy as np
+
+def npz_to_npy(npz_path, key=None):
+    """
+    Converts the array of a prediction .npz into an uncompressed .npy next to it (only if missing or outdated).
+
+    Args:
+        npz_path (str): Path to the .npz (e.g. .../track2d_pred.npz).
+        key (str, optional): Array to extract. By default the key named as the file (e.g. "track2d_pred"),
+            otherwise the first one.
+
+    Returns:
+        str: Path to the .npy.
+    """
+    stem = os.path.splitext(npz_path)[0]
+    npy_path = stem + ".npy" if key is None or key == os.path.basename(stem) else f"{stem}.{key}.npy"
+    npz_mtime = os.path.getmtime(npz_path)  # raises FileNotFoundError if the prediction is missing
+    if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= npz_mtime:
+        return npy_path
+
+    with np.load(npz_path) as data:
+        if key is None:
+            name = os.path.basename(stem)
+            key = name if name in data.files else data.files[0]
+        arr = data[key]
+    # Write to a temporary file and rename, so that concurrent readers never see a partial file
+    tmp_path = f"{os.path.splitext(npy_path)[0]}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, npy_path)
+    return npy_path
+
+def load_tracks(npz_path, frames=None, points=None, key=None):
+    """
+    Loads a track prediction memory-mapped, optionally restricted to a frame range and/or a subset of points.
+
+    Args:
+        npz_path (str): Path to the .npz prediction (converted with npz_to_npy on first use).
+        frames (slice or array, optional): Frames to keep (first axis).
+        points (slice or array, optional): Points to keep (second axis).
+        key (str, optional): See npz_to_npy.
+
+    Returns:
+        np.ndarray: (T, N, C) tracks. With slices (or nothing) this is a read-only view on the memory map,
+                    with index arrays only the selected elements are read into memory.
+    """
+    tracks = np.load(npz_to_npy(npz_path, key), mmap_mode="r")
+    if frames is not None:
+        tracks = tracks[frames]
+    if points is not None:
+        tracks = tracks[:, points]
+    return tracks
+
+def iter_frame_windows(npz_path, window, points=None, key=None):
+    """Yields (first_frame, tracks of the window) over consecutive windows of frames."""
+    num_frames = load_tracks(npz_path, key=key).shape[0]
+    for start in range(0, num_frames, window):
+        yield start, load_tracks(npz_path, frames=slice(start, start + window), points=points, key=key)